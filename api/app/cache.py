@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from pydantic import BaseModel, computed_field
+from typing import Any, Callable, Hashable
+import sys
+import time
+
+
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    max_entries: int
+    max_bytes: int | None
+    hits: int
+    misses: int
+    evictions: int
+
+    @computed_field
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+
+def approximate_size(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, BaseModel):
+        size += approximate_size(value.__dict__)
+    elif isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class LRUCache():
+    def __init__(self, max_entries: int, max_bytes: int | None = None, ttl: float | None = None, sizeof: Callable[[Any], int] = approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size, expires_at)
+        self._entries: OrderedDict[Hashable, tuple[Any, int, float | None]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry == None or (entry[2] != None and entry[2] < time.monotonic()):
+            if entry != None:
+                self.invalidate(key)
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.invalidate(key)
+        size = self.sizeof(value)
+        if self.max_bytes != None and size > self.max_bytes:
+            return
+        self._entries[key] = (value, size, None if self.ttl ==
+                              None else time.monotonic() + self.ttl)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes != None and self.bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted[1]
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry != None:
+            self.bytes -= entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            entries=len(self._entries),
+            bytes=self.bytes,
+            max_entries=self.max_entries,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions)
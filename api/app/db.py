@@ -1,62 +1,67 @@
 from psycopg import Connection
 from psycopg_pool import AsyncConnectionPool
 from fastapi import Request, Depends
-from typing import AsyncGenerator, Annotated, Any
-from os import getenv
-
-
-def get_conn_str():
-    return f"""
-    dbname={getenv('POSTGRES_DB')}
-    user={getenv('POSTGRES_USER')}
-    password={getenv('POSTGRES_PASSWORD')}
-    host={getenv('POSTGRES_HOST')}
-    """
-
-
-def get_db_connection_pool() -> AsyncConnectionPool:
-    return AsyncConnectionPool(
-        conninfo=get_conn_str(), open=False
-    )
+from pydantic import BaseModel
+from collections import deque
+from statistics import quantiles
+from typing import AsyncGenerator, Annotated
+from core.db import get_conn_str, get_db_connection_pool, db_execute, db_fetch_one, db_fetch_all, db_execute_many, db_execute_many_fetch
+import time
+
+
+class DBPoolStats(BaseModel):
+    pool_min: int
+    pool_max: int
+    pool_size: int
+    pool_available: int
+    requests_waiting: int
+    requests_num: int
+    requests_queued: int
+    requests_errors: int
+    usage_ms: int
+    connections_num: int
+    connections_errors: int
+    connections_lost: int
+    acquires: int
+    acquire_p50_ms: float
+    acquire_p99_ms: float
+    acquire_max_ms: float
+
+
+class AcquireLatency():
+    def __init__(self, window: int = 1000):
+        self.acquires = 0
+        self._latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self.acquires += 1
+        self._latencies.append(seconds * 1000)
+
+    def stats(self, db_pool: AsyncConnectionPool) -> DBPoolStats:
+        pool_stats = db_pool.get_stats()
+        latencies = list(self._latencies) or [0]
+        percentiles = quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+        return DBPoolStats(
+            **{field: pool_stats.get(field, 0) for field in DBPoolStats.model_fields if not field.startswith("acquire")},
+            acquires=self.acquires,
+            acquire_p50_ms=percentiles[49],
+            acquire_p99_ms=percentiles[98],
+            acquire_max_ms=max(latencies))
+
+
+acquire_latency = AcquireLatency()
 
 
 async def db_conn(request: Request) -> AsyncGenerator[Connection]:
+    start_time = time.perf_counter()
     async with request.state.db_pool.connection() as conn:
+        acquire_latency.record(time.perf_counter() - start_time)
         yield conn
 
 
 async def db_conn_returns(request: Request) -> Connection:
+    start_time = time.perf_counter()
     async with request.state.db_pool.connection() as conn:
+        acquire_latency.record(time.perf_counter() - start_time)
         return conn
-
-
-async def db_execute(connection: Connection, sql: str, args: list[Any] | None = None) -> None:
-    async with connection.cursor() as cursor:
-        await cursor.execute(sql, args)
-
-
-async def db_fetch_one(connection: Connection, sql: str, args: list[Any] | None = None) -> tuple[Any, ...] | None:
-    async with connection.cursor() as cursor:
-        await cursor.execute(sql, args)
-        return await cursor.fetchone()
-
-
-async def db_fetch_all(connection: Connection, sql: str, args: list[Any] | None = None) -> list[tuple[Any, ...]]:
-    async with connection.cursor() as cursor:
-        await cursor.execute(sql, args)
-        return await cursor.fetchall()
-
-
-async def db_execute_many(connection: Connection, sql: str, args: list[Any] | None = None) -> None:
-    async with connection.cursor() as cursor:
-        await cursor.executemany(sql, args)
-
-
-async def db_execute_many_fetch(connection: Connection, sql: str, args: list[Any] | None = None) -> list[tuple[Any, ...]]:
-    results = []
-    async with connection.cursor() as cursor:
-        await cursor.executemany(sql, args, returning=True)
-        async for _ in cursor.results():
-            results.append(await cursor.fetchone())
-    return results
 type DBConnection = Annotated[Connection, Depends(db_conn)]
@@ -0,0 +1,186 @@
+from fastapi import Request, Response, Depends
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Any, Annotated, Callable
+import brotli
+import msgpack
+import orjson
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+# properties as parallel arrays per field instead of an object per property
+COLUMNAR_JSON_MEDIA_TYPE = "application/x-columnar+json"
+COLUMNAR_MSGPACK_MEDIA_TYPE = "application/x-columnar+msgpack"
+# preferred first when the client accepts several with the same q
+_CONTENT_ENCODINGS = ["br", "gzip"]
+_THREAD_MINIMUM_SIZE = 128 * 1024
+# already compressed, or streamed events that must not be held back
+_EXCLUDED_CONTENT_TYPES = ("text/event-stream", "image/", "audio/", "video/", "application/zip", "application/gzip")
+
+
+def _default(value: Any) -> Any:
+    # models nested in plain results, e.g. a JourneySummary per station group
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def to_json(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+def to_msgpack(content: Any) -> bytes:
+    return msgpack.packb(content, default=_default)
+
+
+def to_columnar(content: Any) -> Any:
+    if isinstance(content, list):
+        return [to_columnar(item) for item in content]
+    if not isinstance(content, dict):
+        return content
+    columnar = {}
+    for key, value in content.items():
+        if key == "properties" and isinstance(value, list):
+            fields = value[0].keys() if value else []
+            columnar[key] = {field: [property[field] for property in value] for field in fields}
+        else:
+            columnar[key] = to_columnar(value)
+    return columnar
+
+
+class JSONBytesResponse(Response):
+    # returned as is by FastAPI, skipping the validation against the response_model
+    media_type = JSON_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
+
+
+_ENCODERS: dict[str, Callable[[Any], bytes]] = {
+    JSON_MEDIA_TYPE: to_json,
+    MSGPACK_MEDIA_TYPE: to_msgpack,
+    COLUMNAR_JSON_MEDIA_TYPE: lambda content: to_json(to_columnar(content)),
+    COLUMNAR_MSGPACK_MEDIA_TYPE: lambda content: to_msgpack(to_columnar(content)),
+}
+
+
+class ResponseEncoder():
+    def __init__(self, media_type: str):
+        self.media_type = media_type
+
+    def response(self, content: Any) -> Response:
+        # caches keep one response per Accept header
+        return Response(_ENCODERS[self.media_type](content), media_type=self.media_type, headers={"Vary": "Accept"})
+
+
+def _parse_quality_values(header: str) -> list[tuple[str, float]]:
+    # the values of an Accept or Accept-Encoding header in order, with their q
+    values = []
+    for item in header.split(","):
+        value, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        values.append((value, quality))
+    return values
+
+
+def get_response_encoder(request: Request) -> ResponseEncoder:
+    # the accepted media type with the highest q we can encode, JSON otherwise
+    accepted = [(-quality, i, media_type) for i, (media_type, quality) in enumerate(_parse_quality_values(request.headers.get("accept", "")))
+                if media_type in _ENCODERS and quality > 0]
+    return ResponseEncoder(min(accepted)[2] if accepted else JSON_MEDIA_TYPE)
+
+
+type NegotiatedEncoder = Annotated[ResponseEncoder, Depends(get_response_encoder)]
+
+
+def get_content_encoding(accept_encoding: str) -> str | None:
+    # the accepted encoding with the highest q, None if the client refuses both
+    qualities = {encoding.lower(): quality for encoding, quality in _parse_quality_values(accept_encoding)}
+    quality, _, encoding = max((qualities.get(encoding, qualities.get("*", 0)), -i, encoding)
+                               for i, encoding in enumerate(_CONTENT_ENCODINGS))
+    return encoding if quality > 0 else None
+
+
+class BrotliResponder():
+    content_encoding = "br"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.quality = quality
+        self.send: Send | None = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.compressor: brotli.Compressor | None = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # held back until the first body tells us whether to compress
+            self.initial_message = message
+            return
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if message["type"] == "http.response.body" and "content-encoding" not in headers \
+                    and self.initial_message["status"] != 206 \
+                    and not headers.get("content-type", "").startswith(_EXCLUDED_CONTENT_TYPES):
+                headers.add_vary_header("Accept-Encoding")
+                if more_body or len(body) >= self.minimum_size:
+                    self.compressor = brotli.Compressor(quality=self.quality)
+                    message["body"] = await self._compress(body, more_body)
+                    headers["Content-Encoding"] = self.content_encoding
+                    if more_body:
+                        del headers["Content-Length"]
+                    else:
+                        headers["Content-Length"] = str(len(message["body"]))
+            await self.send(self.initial_message)
+        elif self.compressor != None and message["type"] == "http.response.body":
+            message["body"] = await self._compress(message.get("body", b""), message.get("more_body", False))
+        await self.send(message)
+
+    async def _compress(self, body: bytes, more_body: bool) -> bytes:
+        # large bodies would block the event loop
+        if len(body) >= _THREAD_MINIMUM_SIZE:
+            return await run_in_threadpool(self._compress_chunk, body, more_body)
+        return self._compress_chunk(body, more_body)
+
+    def _compress_chunk(self, body: bytes, more_body: bool) -> bytes:
+        # a streamed chunk is flushed so that the client can decode it straight away
+        return self.compressor.process(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+
+
+class CompressionMiddleware():
+    # brotli or gzip, whichever the client prefers, gzip is left to Starlette's own responder
+    def __init__(self, app: ASGIApp, minimum_size: int = 1000, compresslevel: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = get_content_encoding(Headers(scope=scope).get("Accept-Encoding", ""))
+        if encoding == "br":
+            responder = BrotliResponder(self.app, self.minimum_size, self.brotli_quality)
+        elif encoding == "gzip":
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
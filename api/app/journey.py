@@ -1,400 +1,346 @@
 from enum import Enum
-from datetime import datetime
-import requests
-import json
 from datetime import datetime, timedelta
-from statistics import mean
-import re
-from fastapi import Depends
-from typing import Annotated, Optional
-from pydantic import BaseModel
-from .db import DBConnection, db_fetch_one, db_execute_many, db_execute_many_fetch
-import aiohttp
+from fastapi import Depends, Request
+from typing import Annotated, AsyncIterator
+from pydantic import BaseModel, computed_field
+from .db import DBConnection, db_fetch_one, db_fetch_all
+from .upstream import JourneyPlannerClient
+from .cache import LRUCache
+from core.journey import JourneyDirection, StartType, DayOfWeek, TrainjourneyOptions, TrainJourneySearchRequest, JourneyTimeDetails, Fare, JourneyFareDetails, JourneyDetails, JourneySummary, TrainJourneySearchResponse
+from core.journey import SUMMARY_COLUMNS, get_journey_key, response_to_summary, cached_columns_to_summary, fetch_journey, store_journeys
+from os import getenv
 import asyncio
-import json
 from time import time
 
 
-class JourneyDirection(str, Enum):
-    OUTBOUND = "OUTBOUND"
-    RETURN = "RETURN"
-
-
-class StartType(str, Enum):
-    DEPART = "DEPART"
-    ARRIVE = "ARRIVE"
-    NONE = "NONE"
-
-
-class DayOfWeek(Enum):
-    SUN = 0
-    MON = 1
-    TUE = 2
-    WED = 3
-    THU = 4
-    FRI = 5
-    SAT = 6
-
-
-class TrainjourneyOptions(BaseModel):
-    start_time: str
-    start_type: StartType
-    return_time: str | None
-    return_type: StartType | None
-    day_of_week: DayOfWeek
-    rail_card: str
-
-    def is_return_journey(self):
-        return self.return_time != None
-
-
-class TrainJourneySearchRequest(TrainjourneyOptions):
-    origin: str
-    destination: str
-
-
-class JourneyTimeDetails(BaseModel):
-    fastest_time: int
-    average_time: int
-    slowest_time: int
-    least_changes: int
-    most_changes: int
-    shortest_wait: int | None = None
-    average_wait: int | None = None
-    longest_wait: int | None = None
-
-
-class Fare(BaseModel):
-    price: int
-    type: str
-    direction: str
-
-    def __lt__(self, other):
-        return self.price < other.price
-
-    def __gt__(self, other):
-        return self.price > other.price
-
-
-class JourneyFareDetails(BaseModel):
-    cheapest_return: Fare | None
-    cheapest_single: Optional[list[Fare]] = None
-
-
-class JourneyDetails(BaseModel):
-    journey_time_details: JourneyTimeDetails
-
-
-class JourneySummary(BaseModel):
-    outbound_details: JourneyDetails
-    return_details: Optional[JourneyDetails] = None
-    fare_details: JourneyFareDetails
-
-
-class TrainJourneySearchResponse(BaseModel):
-    checked_at: datetime
-    data: dict
+class CacheState(str, Enum):
+    FRESH = "FRESH"
+    STALE = "STALE"
+    EXPIRED = "EXPIRED"
+
+
+class JourneyCachePolicy():
+    def __init__(self, fresh_for: timedelta, stale_for: timedelta):
+        self.fresh_for = fresh_for
+        self.stale_for = stale_for
+
+    def get_state(self, checked_at: datetime) -> CacheState:
+        age = datetime.now() - checked_at
+        if age < self.fresh_for:
+            return CacheState.FRESH
+        elif age < self.stale_for:
+            return CacheState.STALE
+        return CacheState.EXPIRED
+
+    def expired_before(self) -> datetime:
+        return datetime.now() - self.stale_for
+
+
+class JourneyCacheStats(BaseModel):
+    hits: int = 0
+    stale: int = 0
+    misses: int = 0
+
+    @computed_field
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(1, self.hits + self.stale + self.misses)
+
+    @computed_field
+    @property
+    def stale_rate(self) -> float:
+        return self.stale / max(1, self.hits + self.stale + self.misses)
+
+    @computed_field
+    @property
+    def miss_rate(self) -> float:
+        return self.misses / max(1, self.hits + self.stale + self.misses)
+
+
+# fresh entries are served, stale entries are served and refreshed in the background, expired entries are fetched again
+journey_cache_policy = JourneyCachePolicy(
+    fresh_for=timedelta(hours=float(getenv("JOURNEY_CACHE_FRESH_HOURS", "168"))),
+    stale_for=timedelta(hours=float(getenv("JOURNEY_CACHE_STALE_HOURS", "720"))))
+journey_cache_stats = JourneyCacheStats()
+# decoded (checked_at, summary) pairs by journeys primary key, in front of the journeys table
+journey_summary_cache = LRUCache(
+    max_entries=int(getenv("JOURNEY_SUMMARY_CACHE_MAX_ENTRIES", "50000")),
+    max_bytes=int(getenv("JOURNEY_SUMMARY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(getenv("JOURNEY_SUMMARY_CACHE_TTL_SECONDS", "900")))
+
+
+class JourneyRefresher():
+    def __init__(self, db_pool, journey_planner: JourneyPlannerClient, max_queued: int = 5000, batch_size: int = 50):
+        self.db_pool = db_pool
+        self.journey_planner = journey_planner
+        self.batch_size = batch_size
+        self._queue = asyncio.Queue(max_queued)
+        self._queued = set()
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task != None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def queue(self, search_requests: list[TrainJourneySearchRequest]) -> None:
+        for search_request in search_requests:
+            key = get_journey_key(search_request)
+            if key in self._queued:
+                continue
+            try:
+                self._queue.put_nowait(search_request)
+            except asyncio.QueueFull:
+                print("Journey refresh queue is full, dropping stale journeys")
+                return
+            self._queued.add(key)
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                async with self.db_pool.connection() as connection:
+                    await JourneyFinder(connection, self.journey_planner, None).refresh(batch)
+            except Exception as e:
+                print(f"Failed to refresh {len(batch)} stale journeys: {e!r}")
+            finally:
+                for search_request in batch:
+                    self._queued.discard(get_journey_key(search_request))
+
+
+async def journey_refresher(request: Request) -> JourneyRefresher:
+    return request.state.journey_refresher
+type JourneyRefresherInstance = Annotated[JourneyRefresher, Depends(
+    journey_refresher)]
 
 
 class JourneyFinder():
-    _ENDPOINT = "https://jpservices.nationalrail.co.uk/journey-planner"
-    _HEADERS = {
-        "Accept-Encoding": "gzip, deflate",
-        "Content-Type": "application/json"
-    }
-    _DATE_FORMAT = "%Y-%m-%d"
-    _GET_CACHED_JOURNEY_QUERY_TEMPLATE = """
-            select checked_at, data from journeys 
+    # the raw response is only fetched for rows cached before summaries were stored, a summary of no journeys leaves the columns null
+    _GET_CACHED_JOURNEY_SUMMARY_QUERY_TEMPLATE = f"""
+            select checked_at, case when summarised_at is null then data end, {", ".join(SUMMARY_COLUMNS)}
+            from journeys
             where origin=%s and destination=%s and start_time=%s and start_type=%s and return_time=%s and return_type=%s and day_of_week=%s and rail_card=%s
             """
-    _GET_CACHED_JOURNEYS_QUERY_TEMPLATE = """
-            select origin, destination, to_char(start_time, 'HH24:MI:SS'), start_type, to_char(return_time, 'HH24:MI:SS'), return_type, day_of_week, rail_card, checked_at, data, s.id, s.name, s.location, ST_X(s.location::geometry), ST_Y(s.location::geometry), %s as "search_id"
-            from journeys as "j" join stations as "s"
-            on s.id=j.origin
-            where origin=%s and destination=%s and start_time=%s and start_type=%s and return_time=%s and return_type=%s and day_of_week=%s and rail_card=%s
-            """
-    _CACHE_JOURNEY_QUERY_TEMPLATE = """
-            insert into journeys (origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card, data)
-            values (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            on conflict (origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card)
-            do update set checked_at=now(), data=excluded.data
+    # looks up all keys in one statement, one array per key column with search_id as the request index
+    _GET_CACHED_JOURNEYS_QUERY_TEMPLATE = f"""
+            select r.search_id, j.checked_at, case when j.summarised_at is null then j.data end, {", ".join([f"j.{column}" for column in SUMMARY_COLUMNS])}
+            from unnest(%s::integer[], %s::text[], %s::text[], %s::time[], %s::journey_type[], %s::time[], %s::journey_type[], %s::day_of_week[], %s::text[])
+            as r(search_id, origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card)
+            join journeys as j
+            on j.origin=r.origin and j.destination=r.destination and j.start_time=r.start_time and j.start_type=r.start_type
+            and j.return_time=r.return_time and j.return_type=r.return_type and j.day_of_week=r.day_of_week and j.rail_card=r.rail_card
             """
+    # upstream lookups currently in progress, shared by all requests in this process
+    _in_flight: dict[tuple, asyncio.Future] = {}
 
-    def __init__(self, connection: DBConnection):
+    def __init__(self, connection: DBConnection, journey_planner: JourneyPlannerClient, refresher: JourneyRefresherInstance):
         self.connection = connection
+        self.journey_planner = journey_planner
+        self.refresher = refresher
 
-    async def search(self, search_request: TrainJourneySearchRequest) -> TrainJourneySearchResponse | None:
-        response = await self._get_cached_journey(search_request)
-        # if no results fetch from api
-        if response == None:
-            response = self._get_journey_from_api(search_request)
-            if response == None or response.data == None:
-                return None
-            # update or store in db
-            await self._cache_journey([(search_request, response)])
+    async def batch_search(self, search_requests: list[TrainJourneySearchRequest]) -> list[JourneySummary | None]:
+        response = [None] * len(search_requests)
+        async for i, summary in self.batch_search_iter(search_requests):
+            response[i] = summary
         return response
 
-    async def batch_search(self, search_requests: list[TrainJourneySearchRequest]) -> list[TrainJourneySearchResponse | None]:
+    async def batch_search_iter(self, search_requests: list[TrainJourneySearchRequest]) -> AsyncIterator[tuple[int, JourneySummary | None]]:
         start_time = time()
-        response = [None] * len(search_requests)
-        found_in_cache = []
-        looked_up = []
-        not_found = []
-        to_cache = []
-        request_args = []
+        found_in_cache = set()
+        stale = []
         for i in range(len(search_requests)):
-            request_args.append([
-                i,
-                search_requests[i].origin,
-                search_requests[i].destination,
-                search_requests[i].start_time,
-                search_requests[i].start_type,
-                search_requests[i].return_time,
-                search_requests[i].return_type,
-                search_requests[i].day_of_week,
-                search_requests[i].rail_card
-            ])
-        cached_journeys = await db_execute_many_fetch(
-            self.connection,
-            JourneyFinder._GET_CACHED_JOURNEYS_QUERY_TEMPLATE,
-            request_args
-        )
+            cached_summary = journey_summary_cache.get(
+                get_journey_key(search_requests[i]))
+            if cached_summary == None:
+                continue
+            cache_state = journey_cache_policy.get_state(cached_summary[0])
+            if cache_state == CacheState.EXPIRED:
+                continue
+            if cache_state == CacheState.STALE:
+                stale.append(search_requests[i])
+            found_in_cache.add(i)
+            yield (i, cached_summary[1])
+        found_in_memory = len(found_in_cache)
+        to_look_up = [i for i in range(len(search_requests))
+                      if i not in found_in_cache]
+        cached_journeys = []
+        if to_look_up:
+            cached_journeys = await db_fetch_all(
+                self.connection,
+                JourneyFinder._GET_CACHED_JOURNEYS_QUERY_TEMPLATE,
+                self._get_journey_key_arrays(
+                    [search_requests[i] for i in to_look_up]),
+                prepare=True
+            )
         for cached_journey in cached_journeys:
-            if cached_journey == None:
+            id = to_look_up[int(cached_journey[0])]
+            cache_state = journey_cache_policy.get_state(cached_journey[1])
+            if cache_state == CacheState.EXPIRED:
                 continue
-            id = int(cached_journey[15])
-            response[id] = self._response_to_summary(TrainJourneySearchResponse(
-                checked_at=cached_journey[8], data=cached_journey[9]))
-            found_in_cache.append(id)
-        cache_finish_time = time()
-        async with aiohttp.ClientSession() as session:
-            futures = []
-            for i in range(len(response)):
-                if response[i] != None:
-                    continue
-                futures.append(asyncio.ensure_future(self._do_post_request(
-                    session, JourneyFinder._HEADERS, self._get_journey_api_request_body(search_requests[i]), i)))
-            for result in await asyncio.gather(*futures):
+            if cache_state == CacheState.STALE:
+                stale.append(search_requests[id])
+            found_in_cache.add(id)
+            summary = cached_columns_to_summary(cached_journey[1:])
+            journey_summary_cache.put(get_journey_key(
+                search_requests[id]), (cached_journey[1], summary))
+            yield (id, summary)
+        self.refresh_later(stale)
+        journey_cache_stats.hits += len(found_in_cache) - len(stale)
+        journey_cache_stats.stale += len(stale)
+        journey_cache_stats.misses += len(search_requests) - len(found_in_cache)
+        print(f"Found journeys cached={len(found_in_cache)} in_memory={found_in_memory} stale={len(stale)} cache_read_time={time()-start_time}")
+        async for result in self._fetch_iter(search_requests, [i for i in range(len(search_requests)) if i not in found_in_cache]):
+            yield result
+
+    async def refresh(self, search_requests: list[TrainJourneySearchRequest]) -> None:
+        async for _ in self._fetch_iter(search_requests, range(len(search_requests))):
+            pass
+
+    def refresh_later(self, search_requests: list[TrainJourneySearchRequest]) -> None:
+        if self.refresher != None and search_requests:
+            self.refresher.queue(search_requests)
+
+    async def _fetch_iter(self, search_requests: list[TrainJourneySearchRequest], indices: list[int]) -> AsyncIterator[tuple[int, JourneySummary | None]]:
+        start_time = time()
+        api_fetch_finish_time = start_time
+        looked_up = []
+        coalesced = []
+        not_found = []
+        to_cache = []
+        futures = []
+        leading = {}
+        try:
+            for i in indices:
+                futures.append(asyncio.ensure_future(
+                    self._fetch_coalesced(search_requests[i], i, leading)))
+            for future in asyncio.as_completed(futures):
+                result = await future
                 if result[1] == None:
                     not_found.append(result[0])
+                    yield (result[0], None)
                     continue
-                looked_up.append(result[0])
-                to_cache.append((search_requests[result[0]], result[1]))
-                response[result[0]] = self._response_to_summary(result[1])
-        api_fetch_finish_time = time()
-        if to_cache:
-            await self._cache_journey(to_cache)
-        cache_update_finish_time = time()
-        print(f"Found journeys cached={len(found_in_cache)} looked_up={len(looked_up)} not_found={len(not_found)} cache_read_time={cache_finish_time-start_time} api_request_time={api_fetch_finish_time-cache_finish_time} cache_update_time={cache_update_finish_time-api_fetch_finish_time}")
-        return response
+                summary = response_to_summary(result[1])
+                if result[2]:
+                    looked_up.append(result[0])
+                    to_cache.append(
+                        (search_requests[result[0]], result[1], summary))
+                else:
+                    coalesced.append(result[0])
+                yield (result[0], summary)
+            api_fetch_finish_time = time()
+            if to_cache:
+                await self._cache_journey(to_cache)
+        finally:
+            # the consumer may stop early, e.g. a streaming client disconnecting
+            for future in futures:
+                future.cancel()
+            self._stop_leading(leading)
+        if futures:
+            print(f"Fetched journeys looked_up={len(looked_up)} coalesced={len(coalesced)} not_found={len(not_found)} api_request_time={api_fetch_finish_time-start_time} cache_update_time={time()-api_fetch_finish_time}")
 
     async def get_journey_summary(self, search_request: TrainJourneySearchRequest) -> JourneySummary | None:
-        journey = await self.search(search_request)
-        if journey == None:
-            return None
-        return self._response_to_summary(journey)
-
-    def _response_to_summary(self, search_response: TrainJourneySearchResponse) -> JourneySummary | None:
-        outbound_time_summary = self._get_journey_time_details(
-            search_response.data, JourneyDirection.OUTBOUND)
-        if outbound_time_summary == None:
-            return None
-        return_time_summary = self._get_journey_time_details(
-            search_response.data, JourneyDirection.RETURN)
-        fare_details = self._get_journey_fare_details(search_response.data)
-        return JourneySummary(
-            outbound_details=JourneyDetails(
-                journey_time_details=outbound_time_summary),
-            return_details=None if return_time_summary == None else JourneyDetails(
-                journey_time_details=return_time_summary),
-            fare_details=fare_details)
-
-    async def _do_post_request(self, session: ClientSession, headers: dict[str, str], body: dict, id):
-        async with session.post(JourneyFinder._ENDPOINT, headers=headers, json=body) as response:
-            if response.status == 400:
-                print("Bad request")
-                return (id, None)
-            elif response.headers["content-type"] != "application/json":
-                print("Non JSON response")
-                print(await response.text())
-                return (id, None)
-            return (id, TrainJourneySearchResponse(checked_at=datetime.now(), data=await response.json()))
-
-    def _get_journey_time_details(self, data: dict, direction: JourneyDirection) -> JourneyTimeDetails | None:
-        durations = []
-        times = []
-        min_changes = None
-        max_changes = None
-        direction_field = "outwardJourneys" if direction == JourneyDirection.OUTBOUND else "inwardJourneys"
-        if direction_field not in data:
-            return None
-        for journey in data[direction_field]:
-            duration = 0
-            for durationPart in journey["duration"].split(" "):
-                durationNumber = int(re.match(r'\d+', durationPart)[0])
-                if durationPart.endswith("h"):
-                    duration += durationNumber * 60
-                elif durationPart.endswith("m"):
-                    duration += durationNumber
-            durations.append(duration)
-
-            times.append(datetime.strptime(
-                journey["timetable"]["scheduled"]["departure"], "%Y-%m-%dT%H:%M:%SZ"))
-
-            changes = len(journey["legs"])
-            if min_changes == None:
-                min_changes = changes
-                max_changes = changes
-            else:
-                min_changes = min(min_changes, changes)
-                max_changes = max(max_changes, changes)
-
-        if len(times) > 1:
-            wait_times = []
-            for i in range(0, len(times)-1, 2):
-                wait_times.append(
-                    int((times[i+1] - times[i]).total_seconds() / 60))
-            return JourneyTimeDetails(
-                fastest_time=min(durations),
-                average_time=int(mean(durations)),
-                slowest_time=max(durations),
-                least_changes=min_changes,
-                most_changes=max_changes,
-                shortest_wait=min(wait_times),
-                average_wait=int(mean(wait_times)),
-                longest_wait=max(wait_times))
-        elif len(times) == 1:
-            return JourneyTimeDetails(
-                fastest_time=min(durations),
-                average_time=int(mean(durations)),
-                slowest_time=max(durations),
-                least_changes=min_changes,
-                most_changes=max_changes)
-        else:
+        key = get_journey_key(search_request)
+        cached_summary = journey_summary_cache.get(key)
+        if cached_summary == None:
+            cached_journey = await db_fetch_one(
+                self.connection,
+                JourneyFinder._GET_CACHED_JOURNEY_SUMMARY_QUERY_TEMPLATE,
+                list(key),
+                prepare=True
+            )
+            if cached_journey != None:
+                cached_summary = (
+                    cached_journey[0], cached_columns_to_summary(cached_journey))
+                journey_summary_cache.put(key, cached_summary)
+        cache_state = None if cached_summary == None else journey_cache_policy.get_state(
+            cached_summary[0])
+        if cache_state == CacheState.FRESH:
+            journey_cache_stats.hits += 1
+            return cached_summary[1]
+        if cache_state == CacheState.STALE:
+            journey_cache_stats.stale += 1
+            self.refresh_later([search_request])
+            return cached_summary[1]
+        journey_cache_stats.misses += 1
+        fetched = await self._fetch(search_request)
+        if fetched == None:
             return None
+        return fetched[1]
 
-    def _get_journey_fare_details(self, data: dict) -> JourneyFareDetails:
-        return_fares = []
-        outbound_single_fares = []
-        inbound_single_fares = []
-        journeys = []
-        if "outwardJourneys" in data:
-            journeys += data["outwardJourneys"]
-        if "inwardJourneys" in data:
-            journeys += data["inwardJourneys"]
-        for journey in journeys:
-            for fare in journey["fares"]:
-                fare_details = Fare(
-                    price=fare["totalPrice"], type=fare["typeDescription"], direction=fare["direction"])
-                if fare_details.direction == "RETURN":
-                    return_fares.append(fare_details)
-                elif fare_details.direction == "OUTWARD":
-                    outbound_single_fares.append(fare_details)
-                elif fare_details.direction == "INWARD":
-                    inbound_single_fares.append(fare_details)
-
-        cheapest_return_fare = None
-        if len(return_fares) != 0:
-            return_fares.sort()
-            cheapest_return_fare = return_fares[0]
-
-        cheapest_single_fares = None
-        if len(outbound_single_fares) != 0:
-            outbound_single_fares.sort()
-            cheapest_single_fares = [outbound_single_fares[0]]
-            if len(inbound_single_fares) != 0:
-                inbound_single_fares.sort()
-                cheapest_single_fares.append(inbound_single_fares[0])
-
-        return JourneyFareDetails(cheapest_return=cheapest_return_fare, cheapest_single=cheapest_single_fares)
-
-    async def _get_cached_journey(self, search_request: TrainJourneySearchRequest) -> TrainJourneySearchResponse | None:
-        cached_journey = await db_fetch_one(
-            self.connection,
-            JourneyFinder._GET_CACHED_JOURNEY_QUERY_TEMPLATE,
-            [
-                search_request.origin,
-                search_request.destination,
-                search_request.start_time,
-                search_request.start_type,
-                search_request.return_time,
-                search_request.return_type,
-                search_request.day_of_week,
-                search_request.rail_card
-            ]
-        )
-        if cached_journey != None:
-            return TrainJourneySearchResponse(checked_at=cached_journey[0], data=cached_journey[1])
-        return None
-
-    def _get_journey_api_request_body(self, search_request: TrainJourneySearchRequest) -> dict:
-        today = datetime.today()
-        current_week_day = today.weekday() + 1 if today.weekday() < 6 else 0
-        if current_week_day < search_request.day_of_week.value:
-            search_date = (today + timedelta(days=search_request.day_of_week.value -
-                                             current_week_day)).strftime(JourneyFinder._DATE_FORMAT)
-        else:
-            search_date = (today + timedelta(days=7 - current_week_day +
-                                             search_request.day_of_week.value)).strftime(JourneyFinder._DATE_FORMAT)
-        outward_time = f"{search_date}T{search_request.start_time}Z"
-        if search_request.return_time != None:
-            inward_time = f"{search_date}T{search_request.return_time}Z"
-
-        api_request_body = {
-            # Assume that numerical destinations are groups rather than stations
-            # e.g. 182 == Any London station
-            # TODO: is there a better way to detect is a station is a group?
-            "origin": {"crs": search_request.origin, "group": search_request.origin.isdigit()},
-            "destination": {"crs": search_request.destination, "group": search_request.destination.isdigit()},
-            "outwardTime": {"travelTime": outward_time, "type": search_request.start_type.name},
-            "fareRequestDetails": {
-                "passengers": {"adult": 1, "child": 0},
-                "fareClass": "ANY",
-                "railcards": [] if search_request.rail_card == None else [{"code": search_request.rail_card, "count": 1}]
-            },
-            "directTrains": False,
-            "reducedTransferTime": False,
-            "onlySearchForSleeper": False,
-            "overtakenTrains": True,
-            "useAlternativeServices": False,
-            "increasedInterchange": "ZERO"
-        }
-        if search_request.return_time != None:
-            api_request_body["inwardTime"] = {
-                "travelTime": inward_time, "type": search_request.return_type.name}
-
-        return api_request_body
-
-    def _get_journey_from_api(self, search_request: TrainJourneySearchRequest) -> TrainJourneySearchResponse | None:
-        api_response = requests.post(
-            JourneyFinder._ENDPOINT, json=self._get_journey_api_request_body(search_request), headers=JourneyFinder._HEADERS)
-
-        if api_response.status_code == 400:
-            print("Bad request for ", search_request)
-            return None
-        return TrainJourneySearchResponse(checked_at=datetime.now(), data=api_response.json())
+    async def _fetch(self, search_request: TrainJourneySearchRequest) -> tuple[TrainJourneySearchResponse, JourneySummary | None] | None:
+        leading = {}
+        try:
+            _, response, led = await self._fetch_coalesced(search_request, None, leading)
+            if response == None:
+                return None
+            summary = response_to_summary(response)
+            if led:
+                await self._cache_journey([(search_request, response, summary)])
+            return (response, summary)
+        finally:
+            self._stop_leading(leading)
+
+    async def _fetch_coalesced(self, search_request: TrainJourneySearchRequest, id, leading: dict[tuple, asyncio.Future]):
+        key = get_journey_key(search_request)
+        while True:
+            in_flight = JourneyFinder._in_flight.get(key)
+            if in_flight == None or in_flight.cancelled():
+                in_flight = asyncio.get_running_loop().create_future()
+                JourneyFinder._in_flight[key] = in_flight
+                leading[key] = in_flight
+                return (id, await self._lead_in_flight(in_flight, search_request), True)
+            try:
+                return (id, await asyncio.shield(in_flight), False)
+            except asyncio.CancelledError:
+                # the leading request went away before its lookup finished, look it up again unless this request went away too
+                if not in_flight.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+    async def _lead_in_flight(self, in_flight: asyncio.Future, search_request: TrainJourneySearchRequest) -> TrainJourneySearchResponse | None:
+        try:
+            response = await fetch_journey(self.journey_planner, search_request)
+        except asyncio.CancelledError:
+            in_flight.cancel()
+            raise
+        except Exception:
+            # waiting requests see a failed lookup as not found
+            in_flight.set_result(None)
+            raise
+        in_flight.set_result(response)
+        return response
 
-    async def _cache_journey(self, journeys: list[tuple[TrainJourneySearchRequest, TrainJourneySearchResponse]]) -> None:
-        args = []
+    def _stop_leading(self, leading: dict[tuple, asyncio.Future]) -> None:
+        # keep keys in flight until cached so that later requests read them from the db
+        for key, in_flight in leading.items():
+            if not in_flight.done():
+                in_flight.cancel()
+            if JourneyFinder._in_flight.get(key) is in_flight:
+                JourneyFinder._in_flight.pop(key)
+
+    def _get_journey_key_arrays(self, search_requests: list[TrainJourneySearchRequest]) -> list[list]:
+        arrays = [list(range(len(search_requests)))] + \
+            [[] for _ in range(8)]
+        for search_request in search_requests:
+            key = get_journey_key(search_request)
+            for i in range(len(key)):
+                arrays[i + 1].append(key[i].name if isinstance(key[i],
+                                     Enum) else key[i])
+        return arrays
+
+    async def _cache_journey(self, journeys: list[tuple[TrainJourneySearchRequest, TrainJourneySearchResponse, JourneySummary | None]]) -> None:
+        await store_journeys(self.connection, journeys)
         for journey in journeys:
-            args.append([
-                journey[0].origin,
-                journey[0].destination,
-                journey[0].start_time,
-                journey[0].start_type,
-                (journey[0].return_time if journey[0].return_time !=
-                 None else "00:00:00"),
-                (journey[0].return_type if journey[0].return_time !=
-                 None else StartType.NONE),
-                journey[0].day_of_week,
-                journey[0].rail_card,
-                json.dumps(journey[1].data)
-            ])
-        await db_execute_many(
-            self.connection,
-            JourneyFinder._CACHE_JOURNEY_QUERY_TEMPLATE,
-            args
-        )
+            journey_summary_cache.put(get_journey_key(
+                journey[0]), (journey[1].checked_at, journey[2]))
 
 
 type JourneyFinderInstance = Annotated[JourneyFinder, Depends(JourneyFinder)]
@@ -1,32 +1,51 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, Request, status
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordRequestForm
 from contextlib import asynccontextmanager
+from os import getenv
 from typing import AsyncIterator, Annotated
-from .db import get_db_connection_pool, DBConnection
-from .property import PropertyNearStationSearchRequest, PropertyFinderInstance, PropertyStationGroup, Property
-from .journey import TrainJourneySearchRequest, JourneyFinderInstance, JourneySummary
-from .search import MatchingPropertySearchRequest, PropertyStationGroupDetails, SearchInstance
+from .db import get_db_connection_pool, DBConnection, DBPoolStats, acquire_latency
+from .cache import CacheStats
+from .encoding import JSONBytesResponse, NegotiatedEncoder, CompressionMiddleware, to_json
+from .upstream import get_journey_planner_client
+from .property import PropertyNearStationSearchRequest, PropertyFinderInstance, PropertyStationGroupPage, PropertyPage, STATION_GROUP_PAGE_SIZE, STATION_GROUP_MAX_PAGE_SIZE
+from .journey import TrainJourneySearchRequest, JourneyFinderInstance, JourneySummary, JourneyRefresher, JourneyCacheStats, journey_cache_stats, journey_summary_cache
+from .tiles import PropertyTileSearchRequest, PropertyTile, PropertyTileFinderInstance, GEOHASH_PATTERN, property_tile_cache
+from .search import MatchingPropertySearchRequest, PropertyStationGroupDetails, SearchInstance, SearchRecorder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from .tasks import fetch_properties_by_stations
-from .user import authenticate_user, create_access_token, Token, CurrentUser
-from .preferences import set_property_preference, remove_property_preference, get_stared_properties, get_hidden_properties, PropertyPreference
+from .tasks import prewarm_journey_cache
+from core.crawl_runs import CrawlRun, get_crawl_runs, trigger_crawl
+from .user import authenticate_user, create_access_token, invalidate_user, require_admin, user_cache, Token, CurrentUser
+from .preferences import set_property_preference, remove_property_preference, get_stared_properties, get_hidden_properties, PropertyPreference, PREFERENCE_PAGE_SIZE, PREFERENCE_MAX_PAGE_SIZE
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
     db_pool = get_db_connection_pool()
     await db_pool.open()
+    journey_planner_client = get_journey_planner_client()
+    await journey_planner_client.open()
+    journey_refresher = JourneyRefresher(db_pool, journey_planner_client)
+    journey_refresher.start()
+    search_recorder = SearchRecorder(db_pool)
+    search_recorder.start()
     scheduler = AsyncIOScheduler()
     scheduler.start()
-    scheduler.add_job(fetch_properties_by_stations, 'interval', minutes=60, args=[
-        db_pool], misfire_grace_time=None)
-    yield {"db_pool": db_pool}
+    scheduler.add_job(prewarm_journey_cache, 'cron', hour=int(getenv("JOURNEY_PREWARM_HOUR", "3")), args=[
+        db_pool, journey_planner_client])
+    yield {"db_pool": db_pool, "journey_planner_client": journey_planner_client, "journey_refresher": journey_refresher, "search_recorder": search_recorder}
     scheduler.shutdown()
+    await search_recorder.stop()
+    await journey_refresher.stop()
+    await journey_planner_client.close()
     await db_pool.close()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware,
+                   minimum_size=int(getenv("COMPRESSION_MINIMUM_SIZE", "1000")),
+                   compresslevel=int(getenv("GZIP_LEVEL", "6")),
+                   brotli_quality=int(getenv("BROTLI_QUALITY", "5")))
 
 
 app.mount("/view", StaticFiles(directory="/code/app/static"), name="static")
@@ -37,9 +56,33 @@ async def index():
     return RedirectResponse(url="/view/index.html", status_code=308)
 
 
-@app.post("/search/near-stations", response_model=list[PropertyStationGroup])
-async def search_near_stations(search_request: PropertyNearStationSearchRequest, current_user: CurrentUser, property_finder: PropertyFinderInstance):
-    return await property_finder.find_properties_near_stations(search_request, current_user)
+@app.post("/search/near-stations", response_model=PropertyStationGroupPage)
+async def search_near_stations(search_request: PropertyNearStationSearchRequest, current_user: CurrentUser, property_finder: PropertyFinderInstance, encoder: NegotiatedEncoder,
+                               cursor: str | None = None, limit: Annotated[int, Query(ge=1, le=STATION_GROUP_MAX_PAGE_SIZE)] = STATION_GROUP_PAGE_SIZE):
+    return encoder.response(await property_finder.find_property_station_groups(search_request, current_user, cursor, limit))
+
+
+@app.post("/search/near-stations/stream")
+async def search_near_stations_stream(search_request: PropertyNearStationSearchRequest, current_user: CurrentUser, property_finder: PropertyFinderInstance):
+    # every group with all of its properties, without holding the result set in memory
+    return StreamingResponse(property_finder.stream_properties_near_stations(search_request, current_user), media_type="application/json")
+
+
+@app.post("/search/near-stations/{station_id}/properties", response_model=PropertyPage)
+async def search_near_station(station_id: str, search_request: PropertyNearStationSearchRequest, current_user: CurrentUser, property_finder: PropertyFinderInstance, encoder: NegotiatedEncoder,
+                              cursor: str | None = None):
+    return encoder.response(await property_finder.find_station_properties(search_request, current_user, station_id, cursor))
+
+
+@app.post("/search/property-tiles", response_model=list[PropertyTile])
+async def search_property_tiles(search_request: PropertyTileSearchRequest, current_user: CurrentUser, tile_finder: PropertyTileFinderInstance, encoder: NegotiatedEncoder):
+    return encoder.response(await tile_finder.find_tiles(search_request, current_user))
+
+
+@app.post("/search/property-tiles/{geohash}/properties", response_model=PropertyPage)
+async def search_property_tile(geohash: Annotated[str, Path(pattern=GEOHASH_PATTERN)], search_request: PropertyTileSearchRequest, current_user: CurrentUser,
+                               tile_finder: PropertyTileFinderInstance, encoder: NegotiatedEncoder, cursor: str | None = None):
+    return encoder.response(await tile_finder.find_tile_properties(search_request, current_user, geohash, cursor))
 
 
 @app.post("/search/train-journey", response_model=JourneySummary)
@@ -48,8 +91,69 @@ async def find_journey(search_request: TrainJourneySearchRequest, journey_finder
 
 
 @app.post("/search/find-properties", response_model=list[PropertyStationGroupDetails])
-async def find_properties(search_request: MatchingPropertySearchRequest, current_user: CurrentUser, search: SearchInstance):
-    return await search.search(search_request, current_user)
+async def find_properties(search_request: MatchingPropertySearchRequest, current_user: CurrentUser, search: SearchInstance, encoder: NegotiatedEncoder):
+    return encoder.response(await search.search(search_request, current_user))
+
+
+@app.post("/search/find-properties/stream")
+async def find_properties_stream(search_request: MatchingPropertySearchRequest, current_user: CurrentUser, search: SearchInstance):
+    async def to_ndjson():
+        async for group in search.search_iter(search_request, current_user):
+            yield to_json(group) + b"\n"
+    return StreamingResponse(to_ndjson(), media_type="application/x-ndjson")
+
+
+@app.get("/internal/journey-cache/stats", response_model=JourneyCacheStats, dependencies=[Depends(require_admin)])
+async def journey_cache_statistics():
+    return journey_cache_stats
+
+
+@app.get("/internal/journey-summary-cache/stats", response_model=CacheStats, dependencies=[Depends(require_admin)])
+async def journey_summary_cache_statistics():
+    return journey_summary_cache.stats()
+
+
+@app.get("/internal/db-pool/stats", response_model=DBPoolStats, dependencies=[Depends(require_admin)])
+async def db_pool_statistics(request: Request):
+    return acquire_latency.stats(request.state.db_pool)
+
+
+@app.get("/internal/property-tile-cache/stats", response_model=CacheStats, dependencies=[Depends(require_admin)])
+async def property_tile_cache_statistics():
+    return property_tile_cache.stats()
+
+
+@app.get("/internal/user-cache/stats", response_model=CacheStats, dependencies=[Depends(require_admin)])
+async def user_cache_statistics():
+    return user_cache.stats()
+
+
+@app.delete("/internal/user-cache", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(require_admin)])
+async def clear_user_cache() -> None:
+    invalidate_user()
+
+
+@app.delete("/internal/user-cache/{username}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(require_admin)])
+async def invalidate_cached_user(username: str) -> None:
+    invalidate_user(username)
+
+
+@app.get("/internal/crawl-runs", response_model=list[CrawlRun], dependencies=[Depends(require_admin)])
+async def crawl_runs(db_connection: DBConnection, limit: int = 20):
+    return await get_crawl_runs(db_connection, limit)
+
+
+@app.post("/internal/crawl-runs", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(require_admin)])
+async def start_crawl_run(db_connection: DBConnection) -> None:
+    await trigger_crawl(db_connection)
+
+
+@app.get("/internal/crawl-runs/{run_id}", response_model=CrawlRun, dependencies=[Depends(require_admin)])
+async def crawl_run(run_id: int, db_connection: DBConnection):
+    runs = await get_crawl_runs(db_connection, 1, run_id)
+    if not runs:
+        raise HTTPException(status_code=404, detail="Crawl run not found")
+    return runs[0]
 
 
 @app.post("/user/star-property/{property_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -62,9 +166,10 @@ async def unstar_property(property_id: int, db_connection: DBConnection, current
     await remove_property_preference(db_connection, current_user, property_id)
 
 
-@app.get("/user/stared-properties", response_model=list[Property])
-async def stared_properties(db_connection: DBConnection, current_user: CurrentUser):
-    return await get_stared_properties(db_connection, current_user)
+@app.get("/user/stared-properties", response_model=PropertyPage)
+async def stared_properties(db_connection: DBConnection, current_user: CurrentUser,
+                            cursor: str | None = None, limit: Annotated[int, Query(ge=1, le=PREFERENCE_MAX_PAGE_SIZE)] = PREFERENCE_PAGE_SIZE):
+    return JSONBytesResponse(await get_stared_properties(db_connection, current_user, cursor, limit))
 
 
 @app.post("/user/hide-property/{property_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -77,9 +182,10 @@ async def unhide_property(property_id: int, db_connection: DBConnection, current
     await remove_property_preference(db_connection, current_user, property_id)
 
 
-@app.get("/user/hidden-properties", response_model=list[Property])
-async def hidden_properties(db_connection: DBConnection, current_user: CurrentUser):
-    return await get_hidden_properties(db_connection, current_user)
+@app.get("/user/hidden-properties", response_model=PropertyPage)
+async def hidden_properties(db_connection: DBConnection, current_user: CurrentUser,
+                            cursor: str | None = None, limit: Annotated[int, Query(ge=1, le=PREFERENCE_MAX_PAGE_SIZE)] = PREFERENCE_PAGE_SIZE):
+    return JSONBytesResponse(await get_hidden_properties(db_connection, current_user, cursor, limit))
 
 
 @app.post("/auth/token", response_model=Token)
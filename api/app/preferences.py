@@ -1,13 +1,27 @@
-from .db import DBConnection, db_execute, db_fetch_all
+from .db import DBConnection, db_execute, db_fetch_one, db_fetch_all
 from .user import CurrentUser
-from .property import Property
+from .property import row_to_property, to_cursor, from_cursor
 from .enums import PropertyPreference
+from os import getenv
+
+PREFERENCE_PAGE_SIZE = int(getenv("PREFERENCE_PAGE_SIZE", "50"))
+PREFERENCE_MAX_PAGE_SIZE = int(getenv("PREFERENCE_MAX_PAGE_SIZE", "200"))
 
 _PROPERTY_WITH_PREFERENCE_QUERY_TEMPLATE = """
     select id, ST_X(location::geometry), ST_Y(location::geometry), address, price, bedrooms, bathrooms, pref.preference = 'STAR'
     from properties as prop join property_preferences pref
-    on pref.property_id=prop.id and pref.user_id=%s
-    where pref.preference=%s
+    on pref.property_id=prop.id and pref.user_id=%(username)s
+    where pref.preference=%(preference)s
+    and (%(after_id)s::bigint is null or prop.id > %(after_id)s)
+    order by prop.id
+    limit %(limit)s
+    """
+# the total is only returned on the first page, a first page that holds every property needs no count
+_PROPERTY_WITH_PREFERENCE_COUNT_QUERY_TEMPLATE = """
+    select count(*)
+    from properties as prop join property_preferences pref
+    on pref.property_id=prop.id and pref.user_id=%(username)s
+    where pref.preference=%(preference)s
     """
 
 
@@ -15,25 +29,30 @@ async def set_property_preference(db_connection: DBConnection, user: CurrentUser
     await db_execute(db_connection, """
                      insert into property_preferences (property_id, user_id, preference) values (%s, %s, %s)
                      on conflict (property_id, user_id)
-                     do update set preference=excluded.preference""", [property_id, user.username, preference])
+                     do update set preference=excluded.preference""", [property_id, user.username, preference], prepare=True)
 
 
 async def remove_property_preference(db_connection: DBConnection, user: CurrentUser, property_id: int) -> None:
-    await db_execute(db_connection, "delete from property_preferences where property_id=%s and user_id=%s", [property_id, user.username])
+    await db_execute(db_connection, "delete from property_preferences where property_id=%s and user_id=%s", [property_id, user.username], prepare=True)
 
 
-async def _get_property_with_preference(db_connection: DBConnection, user: CurrentUser, preference: PropertyPreference):
-    rows = await db_fetch_all(db_connection, _PROPERTY_WITH_PREFERENCE_QUERY_TEMPLATE, [user.username, preference])
-    properties = []
-    for row in rows:
-        properties.append(Property(id=str(row[0]), location=(
-            row[1], row[2]), address=row[3], price=row[4], bedrooms=row[5], bathrooms=row[6], star=row[7]))
-    return properties
+async def _get_property_with_preference(db_connection: DBConnection, user: CurrentUser, preference: PropertyPreference, cursor: str | None, limit: int) -> dict:
+    after_id = from_cursor(cursor, int)[0]
+    args = {"username": user.username, "preference": preference, "after_id": after_id, "limit": limit + 1}
+    rows = await db_fetch_all(db_connection, _PROPERTY_WITH_PREFERENCE_QUERY_TEMPLATE, args, prepare=True)
+    total = None
+    if after_id == None:
+        total = len(rows) if len(rows) <= limit else (await db_fetch_one(db_connection, _PROPERTY_WITH_PREFERENCE_COUNT_QUERY_TEMPLATE, args, prepare=True))[0]
+    return {
+        "properties": [row_to_property(row, row[7]) for row in rows[:limit]],
+        "total": total,
+        "next_cursor": to_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    }
 
 
-async def get_stared_properties(db_connection: DBConnection, user: CurrentUser) -> list[Property]:
-    return await _get_property_with_preference(db_connection, user, PropertyPreference.STAR)
+async def get_stared_properties(db_connection: DBConnection, user: CurrentUser, cursor: str | None = None, limit: int = PREFERENCE_PAGE_SIZE) -> dict:
+    return await _get_property_with_preference(db_connection, user, PropertyPreference.STAR, cursor, limit)
 
 
-async def get_hidden_properties(db_connection: DBConnection, user: CurrentUser) -> list[Property]:
-    return await _get_property_with_preference(db_connection, user, PropertyPreference.HIDE)
+async def get_hidden_properties(db_connection: DBConnection, user: CurrentUser, cursor: str | None = None, limit: int = PREFERENCE_PAGE_SIZE) -> dict:
+    return await _get_property_with_preference(db_connection, user, PropertyPreference.HIDE, cursor, limit)
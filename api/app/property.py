@@ -1,9 +1,12 @@
 from .db import DBConnection, db_fetch_all
-from pydantic import BaseModel
-from typing import Optional, Annotated
-from fastapi import Depends
+from pydantic import BaseModel, Field
+from typing import Optional, Annotated, AsyncIterator
+from fastapi import Depends, HTTPException
+from os import getenv
 from .enums import PropertyPreference
 from .user import CurrentUser
+from .encoding import to_json
+from core.property_stations import PROPERTY_STATION_MAX_DISTANCE
 
 
 class SimplePropertySearchRequest(BaseModel):
@@ -15,8 +18,18 @@ class SimplePropertySearchRequest(BaseModel):
     max_bathrooms: Optional[int] = None
 
 
+_PROPERTY_PAGE_SIZE = int(getenv("PROPERTY_PAGE_SIZE", "20"))
+_PROPERTY_MAX_PAGE_SIZE = int(getenv("PROPERTY_MAX_PAGE_SIZE", "200"))
+STATION_GROUP_PAGE_SIZE = int(getenv("STATION_GROUP_PAGE_SIZE", "20"))
+STATION_GROUP_MAX_PAGE_SIZE = int(getenv("STATION_GROUP_MAX_PAGE_SIZE", "100"))
+# rows fetched from the server side cursor and written to the response at a time
+_STREAM_CHUNK_SIZE = int(getenv("PROPERTY_STREAM_CHUNK_SIZE", "1000"))
+
+
 class PropertyNearStationSearchRequest(SimplePropertySearchRequest):
-    max_station_distance: int
+    max_station_distance: int = Field(le=PROPERTY_STATION_MAX_DISTANCE)
+    # properties per station group and per page of a group
+    page_size: int = Field(default=_PROPERTY_PAGE_SIZE, ge=1, le=_PROPERTY_MAX_PAGE_SIZE)
 
 
 class Property(BaseModel):
@@ -29,6 +42,13 @@ class Property(BaseModel):
     star: bool
 
 
+class PropertyPage(BaseModel):
+    properties: list[Property]
+    # only counted for the first page
+    total: int | None = None
+    next_cursor: str | None = None
+
+
 class Station(BaseModel):
     id: str
     name: str
@@ -37,47 +57,199 @@ class Station(BaseModel):
 
 class PropertyStationGroup(BaseModel):
     station: Station
+    # the cheapest page of properties, the rest are fetched with next_cursor
     properties: list[Property]
+    total: int
+    next_cursor: str | None = None
+
+
+class PropertyStationGroupPage(BaseModel):
+    groups: list[PropertyStationGroup]
+    next_cursor: str | None = None
+
+
+# keyset cursors are the sort key of the last row of a page, e.g. "<price>:<id>"
+def to_cursor(*values) -> str:
+    return ":".join(str(value) for value in values)
+
+
+def from_cursor(cursor: str | None, *types: type) -> list:
+    if cursor == None:
+        return [None] * len(types)
+    values = cursor.split(":")
+    try:
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return [to_type(value) for to_type, value in zip(types, values)]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# rows are turned into plain dicts of the Property and Station schema and encoded
+# without validating a model per row, the models only describe the responses
+def row_to_property(row: tuple, star: bool) -> dict:
+    return {"id": str(row[0]), "location": (row[1], row[2]), "address": str(row[3]), "price": row[4], "bedrooms": row[5], "bathrooms": row[6], "star": star}
+
+
+def row_to_station(row: tuple) -> dict:
+    return {"id": str(row[7]), "name": str(row[8]), "location": (row[9], row[10])}
+
+
+# conditions on properties "p" and the user's property_preferences "pref" for a SimplePropertySearchRequest
+PROPERTY_FILTER_CONDITIONS = """
+                not p.historic
+                and (pref.preference is null or pref.preference != 'HIDE')
+                and (%(max_price)s::smallint is null or p.price <= %(max_price)s)
+                and (%(min_price)s::smallint is null or p.price >= %(min_price)s)
+                and (%(max_bedrooms)s::smallint is null or p.bedrooms <= %(max_bedrooms)s)
+                and (%(min_bedrooms)s::smallint is null or p.bedrooms >= %(min_bedrooms)s)
+                and (%(max_bathrooms)s::smallint is null or (p.bathrooms is null or p.bathrooms <= %(max_bathrooms)s))
+                and (%(min_bathrooms)s::smallint is null or (p.bathrooms is null or p.bathrooms >= %(min_bathrooms)s))
+            """
 
 
 class PropertyFinder():
-    _SEARCH_BY_NEAR_STATIONS_QUERY_TEMPLATE = """
+    # property_station holds the distances, the station ids use its (station_id, distance_m) index.
+    # every group gets its cheapest page of properties and the count of all of them
+    _SEARCH_QUERY_TEMPLATE = """
+                select * from (
+                    select 
+                    p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), p.address, p.price, p.bedrooms, p.bathrooms, 
+                    s.id as "station_id", s.name, ST_X(s.location::geometry), ST_Y(s.location::geometry),
+                    pref.preference,
+                    count(*) over (partition by ps.station_id) as "total",
+                    row_number() over (partition by ps.station_id order by p.price, p.id) as "property_rank",
+                    dense_rank() over (order by ps.station_id) as "group_rank"
+                    from property_station as ps
+                    join properties as p on p.id=ps.property_id
+                    join stations as s on s.id=ps.station_id
+                    left outer join property_preferences as pref
+                    on pref.user_id=%(username)s and pref.property_id=p.id
+                    where 
+                    ps.distance_m <= %(max_station_distance)s
+                    and {station_condition}
+                    and {filter_conditions}
+                ) as ranked
+                where property_rank <= %(page_size)s
+                and (%(group_limit)s::integer is null or group_rank <= %(group_limit)s)
+                order by group_rank, property_rank
+            """
+    _SEARCH_BY_NEAR_STATIONS_QUERY_TEMPLATE = _SEARCH_QUERY_TEMPLATE.format(
+        station_condition="(%(after_station)s::text is null or ps.station_id > %(after_station)s)", filter_conditions=PROPERTY_FILTER_CONDITIONS)
+    _SEARCH_BY_STATION_IDS_QUERY_TEMPLATE = _SEARCH_QUERY_TEMPLATE.format(
+        station_condition="ps.station_id = any(%(station_ids)s::text[])", filter_conditions=PROPERTY_FILTER_CONDITIONS)
+    # the next page of a group, after the (price, id) of the last property
+    _STATION_PROPERTIES_QUERY_TEMPLATE = f"""
                 select 
-                p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), address, price, bedrooms, bathrooms, 
+                p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), p.address, p.price, p.bedrooms, p.bathrooms, 
+                pref.preference
+                from property_station as ps
+                join properties as p on p.id=ps.property_id
+                left outer join property_preferences as pref
+                on pref.user_id=%(username)s and pref.property_id=p.id
+                where 
+                ps.station_id=%(station_id)s
+                and ps.distance_m <= %(max_station_distance)s
+                and (%(after_price)s::integer is null or (p.price, p.id) > (%(after_price)s, %(after_id)s::bigint))
+                and {PROPERTY_FILTER_CONDITIONS}
+                order by p.price, p.id
+                limit %(limit)s
+            """
+
+    # every matching property, ordered by station so that groups are built in a single pass
+    _STREAM_QUERY_TEMPLATE = f"""
+                select 
+                p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), p.address, p.price, p.bedrooms, p.bathrooms, 
                 s.id, s.name, ST_X(s.location::geometry), ST_Y(s.location::geometry),
                 pref.preference
-                from properties as p join stations as s 
-                on ST_DWithin(p.location, s.location, %(max_station_distance)s)
+                from property_station as ps
+                join properties as p on p.id=ps.property_id
+                join stations as s on s.id=ps.station_id
                 left outer join property_preferences as pref
                 on pref.user_id=%(username)s and pref.property_id=p.id
                 where 
-                (pref.preference is null or pref.preference != 'HIDE')
-                and (%(max_price)s::smallint is null or p.price <= %(max_price)s)
-                and (%(min_price)s::smallint is null or p.price >= %(min_price)s)
-                and (%(max_bedrooms)s::smallint is null or p.bedrooms <= %(max_bedrooms)s)
-                and (%(min_bedrooms)s::smallint is null or p.bedrooms >= %(min_bedrooms)s)
-                and (%(max_bathrooms)s::smallint is null or (p.bathrooms is null or p.bathrooms <= %(max_bathrooms)s))
-                and (%(min_bathrooms)s::smallint is null or (p.bathrooms is null or p.bathrooms >= %(min_bathrooms)s))
+                ps.distance_m <= %(max_station_distance)s
+                and {PROPERTY_FILTER_CONDITIONS}
+                order by ps.station_id, p.price, p.id
             """
 
     def __init__(self, connection: DBConnection):
         self.connection = connection
 
-    async def find_properties_near_stations(self, request: PropertyNearStationSearchRequest, user: CurrentUser) -> list[PropertyStationGroup]:
+    async def find_properties_near_stations(self, request: PropertyNearStationSearchRequest, user: CurrentUser, station_ids: list[str] | None = None, after_station: str | None = None, group_limit: int | None = None) -> list[dict]:
         args = request.model_dump()
         args["username"] = user.username
-        rows = await db_fetch_all(self.connection, PropertyFinder._SEARCH_BY_NEAR_STATIONS_QUERY_TEMPLATE, args)
+        args["station_ids"] = station_ids
+        args["after_station"] = after_station
+        args["group_limit"] = group_limit
+        query = PropertyFinder._SEARCH_BY_NEAR_STATIONS_QUERY_TEMPLATE if station_ids == None else PropertyFinder._SEARCH_BY_STATION_IDS_QUERY_TEMPLATE
+        rows = await db_fetch_all(self.connection, query, args, prepare=True)
         groups = {}
         for row in rows:
-            station = Station(id=str(row[7]), name=str(
-                row[8]), location=(row[9], row[10]))
-            groups.setdefault(station.id, (station, []))[1].append(
-                Property(id=str(row[0]), location=(row[1], row[2]), address=str(row[3]), price=str(row[4]), bedrooms=row[5], bathrooms=row[6], star=row[11] == PropertyPreference.STAR.name))
-        results = []
+            group = groups.get(row[7])
+            if group == None:
+                group = groups[row[7]] = {"station": row_to_station(
+                    row), "properties": [], "total": row[12], "next_cursor": None}
+            group["properties"].append(row_to_property(
+                row, row[11] == PropertyPreference.STAR.name))
         for group in groups.values():
-            results.append(PropertyStationGroup(
-                station=group[0], properties=group[1]))
-        return results
+            if group["total"] > len(group["properties"]):
+                last = group["properties"][-1]
+                group["next_cursor"] = to_cursor(last["price"], last["id"])
+        return list(groups.values())
+
+    async def stream_properties_near_stations(self, request: PropertyNearStationSearchRequest, user: CurrentUser) -> AsyncIterator[bytes]:
+        # a JSON list of PropertyStationGroup with all of their properties, written as the rows arrive
+        args = request.model_dump()
+        args["username"] = user.username
+        chunk = [b"["]
+        station_id = None
+        total = 0
+        # a named cursor only lives inside a transaction
+        async with self.connection.transaction():
+            async with self.connection.cursor(name="property_stream") as cursor:
+                cursor.itersize = _STREAM_CHUNK_SIZE
+                await cursor.execute(PropertyFinder._STREAM_QUERY_TEMPLATE, args)
+                async for row in cursor:
+                    if row[7] != station_id:
+                        if station_id != None:
+                            chunk.append(b'],"total":%d},' % total)
+                        station_id = row[7]
+                        total = 0
+                        chunk.append(
+                            b'{"station":%b,"properties":[' % to_json(row_to_station(row)))
+                    elif total > 0:
+                        chunk.append(b",")
+                    chunk.append(to_json(row_to_property(
+                        row, row[11] == PropertyPreference.STAR.name)))
+                    total += 1
+                    if len(chunk) >= _STREAM_CHUNK_SIZE:
+                        yield b"".join(chunk)
+                        chunk = []
+        if station_id != None:
+            chunk.append(b'],"total":%d}' % total)
+        chunk.append(b"]")
+        yield b"".join(chunk)
+
+    async def find_property_station_groups(self, request: PropertyNearStationSearchRequest, user: CurrentUser, cursor: str | None = None, limit: int = STATION_GROUP_PAGE_SIZE) -> dict:
+        # one group more than asked for tells whether there is a next page
+        groups = await self.find_properties_near_stations(request, user, after_station=from_cursor(cursor, str)[0], group_limit=limit + 1)
+        if len(groups) > limit:
+            return {"groups": groups[:limit], "next_cursor": to_cursor(groups[limit - 1]["station"]["id"])}
+        return {"groups": groups, "next_cursor": None}
+
+    async def find_station_properties(self, request: PropertyNearStationSearchRequest, user: CurrentUser, station_id: str, cursor: str | None = None) -> dict:
+        args = request.model_dump()
+        args["username"] = user.username
+        args["station_id"] = station_id
+        args["after_price"], args["after_id"] = from_cursor(cursor, int, int)
+        args["limit"] = request.page_size + 1
+        rows = await db_fetch_all(self.connection, PropertyFinder._STATION_PROPERTIES_QUERY_TEMPLATE, args, prepare=True)
+        properties = [row_to_property(row, row[7] == PropertyPreference.STAR.name)
+                      for row in rows[:request.page_size]]
+        if len(rows) > request.page_size:
+            return {"properties": properties, "total": None, "next_cursor": to_cursor(rows[request.page_size - 1][4], rows[request.page_size - 1][0])}
+        return {"properties": properties, "total": None, "next_cursor": None}
 
 
 type PropertyFinderInstance = Annotated[PropertyFinder, Depends(
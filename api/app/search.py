@@ -1,61 +1,264 @@
-from pydantic import BaseModel
-from typing import Optional, Annotated
+from enum import Enum
+from typing import Annotated, AsyncIterator
 from fastapi import Depends, Request
-from .journey import StartType, DayOfWeek
-from .db import DBConnection, db_conn_returns
-from .property import PropertyFinderInstance, PropertyNearStationSearchRequest, Station, Property, PropertyStationGroup
-from .journey import JourneyFinderInstance, JourneyFinder, TrainJourneySearchRequest, JourneySummary, TrainjourneyOptions
+from .journey import StartType, SUMMARY_COLUMNS, CacheState, get_journey_key, cached_columns_to_summary, journey_cache_policy, journey_cache_stats, journey_summary_cache
+from .db import DBConnection, db_fetch_all, db_execute_many
+from .property import PropertyFinderInstance, PropertyNearStationSearchRequest, Station, PropertyStationGroup, PROPERTY_FILTER_CONDITIONS
+from .journey import JourneyFinderInstance, TrainJourneySearchRequest, JourneySummary, TrainjourneyOptions
 from .user import CurrentUser
+from datetime import datetime
+from os import getenv
+import asyncio
+
+# stations whose journeys arrived while streaming are looked up together, up to this many per query
+_STREAM_STATION_BATCH_SIZE = int(getenv("SEARCH_STREAM_STATION_BATCH_SIZE", "20"))
+# or after this long, so that a group is not held back waiting for the rest of its batch
+_STREAM_FLUSH_SECONDS = float(getenv("SEARCH_STREAM_FLUSH_SECONDS", "0.25"))
+
+
+class SearchPlan(str, Enum):
+    # find properties near every station, then look up journeys for all of them
+    PROPERTIES_FIRST = "PROPERTIES_FIRST"
+    # discard stations by cached journey time, then find properties near the rest
+    JOURNEYS_FIRST = "JOURNEYS_FIRST"
 
 
 class MatchingPropertySearchRequest(PropertyNearStationSearchRequest, TrainjourneyOptions):
     max_journey_time: int
     destination: str
+    plan: SearchPlan = SearchPlan.PROPERTIES_FIRST
 
 
 class PropertyStationGroupDetails(PropertyStationGroup):
     journey_summary: JourneySummary
 
 
+class SearchRecorder():
+    # searches are kept in memory and written in batches instead of once per search request
+    _RECORD_SEARCHES_QUERY_TEMPLATE = """
+                insert into journey_searches (destination, start_time, start_type, return_time, return_type, day_of_week, rail_card, searched_at)
+                values (%s, %s, %s, %s, %s, %s, %s, %s)
+            """
+
+    def __init__(self, db_pool, flush_interval: float = float(getenv("SEARCH_RECORD_FLUSH_SECONDS", "10")), max_buffered: int = 10000):
+        self.db_pool = db_pool
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._buffer = []
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task != None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def record(self, search_request: TrainJourneySearchRequest) -> None:
+        if len(self._buffer) >= self.max_buffered:
+            print("Search record buffer is full, dropping search")
+            return
+        self._buffer.append([*get_journey_key(search_request)[1:], datetime.now()])
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        batch = self._buffer
+        self._buffer = []
+        try:
+            async with self.db_pool.connection() as connection:
+                await db_execute_many(connection, SearchRecorder._RECORD_SEARCHES_QUERY_TEMPLATE, batch)
+        except Exception as e:
+            print(f"Failed to record {len(batch)} searches: {e!r}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+async def search_recorder(request: Request) -> SearchRecorder:
+    return request.state.search_recorder
+type SearchRecorderInstance = Annotated[SearchRecorder, Depends(
+    search_recorder)]
+
+
 class Search():
-    def __init__(self, connection: DBConnection, property_finder: PropertyFinderInstance, journey_finder: JourneyFinderInstance, request: Request):
+    # stations with at least one matching property, with their cached journey if there is one
+    _CANDIDATE_STATIONS_QUERY_TEMPLATE = f"""
+                select
+                s.id, s.name, ST_X(s.location::geometry), ST_Y(s.location::geometry),
+                j.origin is not null, j.checked_at, case when j.summarised_at is null then j.data end, {", ".join([f"j.{column}" for column in SUMMARY_COLUMNS])}
+                from stations as s
+                left outer join journeys as j
+                on j.origin=s.id and j.destination=%(destination)s and j.start_time=%(start_time)s::time and j.start_type=%(start_type)s::journey_type
+                and j.return_time=%(return_time)s::time and j.return_type=%(return_type)s::journey_type and j.day_of_week=%(day_of_week)s::day_of_week and j.rail_card=%(rail_card)s
+                where
+                (j.checked_at is null or j.checked_at < %(expired_before)s or (
+                    (j.outbound_fastest_time is null or j.outbound_fastest_time <= %(max_journey_time)s)
+                    and (j.return_fastest_time is null or j.return_fastest_time <= %(max_journey_time)s)
+                ))
+                and exists (
+                    select 1 from property_station as ps
+                    join properties as p on p.id=ps.property_id
+                    left outer join property_preferences as pref
+                    on pref.user_id=%(username)s and pref.property_id=p.id
+                    where ps.station_id=s.id and ps.distance_m <= %(max_station_distance)s
+                    and {PROPERTY_FILTER_CONDITIONS}
+                )
+            """
+
+    def __init__(self, connection: DBConnection, property_finder: PropertyFinderInstance, journey_finder: JourneyFinderInstance, recorder: SearchRecorderInstance, request: Request):
         self.connection = connection
         self.property_finder = property_finder
         self.journey_finder = journey_finder
+        self.recorder = recorder
         self.request = request
 
-    async def search(self, search_request: MatchingPropertySearchRequest, user: CurrentUser) -> list[PropertyStationGroup]:
+    async def search(self, search_request: MatchingPropertySearchRequest, user: CurrentUser) -> list[dict]:
+        print(f"Searching for properties matching {search_request}")
+        self._record_search(search_request)
+        if search_request.plan == SearchPlan.JOURNEYS_FIRST:
+            stations, journeys, uncached_stations = await self._find_candidate_stations(search_request, user)
+            uncached_journeys = await self.journey_finder.batch_search(
+                [self._get_journey_request(search_request, station) for station in uncached_stations])
+            for i in range(len(uncached_stations)):
+                if self._is_acceptable_journey(search_request, uncached_journeys[i]):
+                    stations.append(uncached_stations[i])
+                    journeys[uncached_stations[i].id] = uncached_journeys[i]
+            return await self._find_properties_near(search_request, user, stations, journeys)
         results = []
+        properties = await self._find_properties(search_request, user)
+        journeys = await self.journey_finder.batch_search([self._get_journey_request(search_request, Station(**group["station"])) for group in properties])
+        for i in range(len(properties)):
+            if self._is_acceptable_journey(search_request, journeys[i]):
+                results.append(
+                    {**properties[i], "journey_summary": journeys[i]})
+        return results
+
+    async def search_iter(self, search_request: MatchingPropertySearchRequest, user: CurrentUser) -> AsyncIterator[dict]:
         print(f"Searching for properties matching {search_request}")
+        self._record_search(search_request)
+        if search_request.plan == SearchPlan.JOURNEYS_FIRST:
+            stations, journeys, uncached_stations = await self._find_candidate_stations(search_request, user)
+            for group in await self._find_properties_near(search_request, user, stations, journeys):
+                yield group
+            async for acceptable_stations in self._stream_acceptable_stations(search_request, uncached_stations, journeys):
+                for group in await self._find_properties_near(search_request, user, acceptable_stations, journeys):
+                    yield group
+            return
+        properties = await self._find_properties(search_request, user)
+        async for i, journey in self.journey_finder.batch_search_iter([self._get_journey_request(search_request, Station(**group["station"])) for group in properties]):
+            if self._is_acceptable_journey(search_request, journey):
+                yield {**properties[i], "journey_summary": journey}
+
+    async def _stream_acceptable_stations(self, search_request: MatchingPropertySearchRequest, stations: list[Station], journeys: dict[str, JourneySummary]) -> AsyncIterator[list[Station]]:
+        # the first acceptable station is sent straight away, later ones are held for at most
+        # _STREAM_FLUSH_SECONDS or until a batch is full, even while no further journey arrives
+        loop = asyncio.get_running_loop()
+        journey_iter = aiter(self.journey_finder.batch_search_iter([self._get_journey_request(search_request, station) for station in stations]))
+        next_journey = asyncio.ensure_future(anext(journey_iter, None))
+        acceptable_stations = []
+        flush_at = loop.time()
+        try:
+            while True:
+                timeout = max(0, flush_at - loop.time()) if acceptable_stations else None
+                done, _ = await asyncio.wait([next_journey], timeout=timeout)
+                if done:
+                    result = next_journey.result()
+                    if result == None:
+                        break
+                    i, journey = result
+                    next_journey = asyncio.ensure_future(anext(journey_iter, None))
+                    if self._is_acceptable_journey(search_request, journey):
+                        acceptable_stations.append(stations[i])
+                        journeys[stations[i].id] = journey
+                if acceptable_stations and (len(acceptable_stations) >= _STREAM_STATION_BATCH_SIZE or loop.time() >= flush_at):
+                    yield acceptable_stations
+                    acceptable_stations = []
+                    flush_at = loop.time() + _STREAM_FLUSH_SECONDS
+        finally:
+            next_journey.cancel()
+        if acceptable_stations:
+            yield acceptable_stations
+
+    def _record_search(self, search_request: MatchingPropertySearchRequest) -> None:
+        # popular journey options are used to pre-warm the journey cache
+        self.recorder.record(self._get_journey_request(search_request, None))
+
+    async def _find_candidate_stations(self, search_request: MatchingPropertySearchRequest, user: CurrentUser) -> tuple[list[Station], dict[str, JourneySummary], list[Station]]:
+        args = search_request.model_dump()
+        args["username"] = user.username
+        args["expired_before"] = journey_cache_policy.expired_before()
+        key = get_journey_key(self._get_journey_request(search_request, None))
+        for i, column in enumerate(["destination", "start_time", "start_type", "return_time", "return_type", "day_of_week", "rail_card"]):
+            args[column] = key[i + 1].name if isinstance(key[i + 1], Enum) else key[i + 1]
+        rows = await db_fetch_all(self.connection, Search._CANDIDATE_STATIONS_QUERY_TEMPLATE, args)
+        stations = []
+        journeys = {}
+        uncached_stations = []
+        stale = []
+        for row in rows:
+            station = Station(id=str(row[0]), name=str(
+                row[1]), location=(row[2], row[3]))
+            cache_state = CacheState.EXPIRED if not row[4] else journey_cache_policy.get_state(
+                row[5])
+            if cache_state == CacheState.EXPIRED:
+                uncached_stations.append(station)
+                continue
+            journey_request = self._get_journey_request(search_request, station)
+            if cache_state == CacheState.STALE:
+                stale.append(journey_request)
+            journey = cached_columns_to_summary(row[5:])
+            journey_summary_cache.put(
+                get_journey_key(journey_request), (row[5], journey))
+            if self._is_acceptable_journey(search_request, journey):
+                stations.append(station)
+                journeys[station.id] = journey
+        self.journey_finder.refresh_later(stale)
+        journey_cache_stats.hits += len(rows) - len(uncached_stations) - len(stale)
+        journey_cache_stats.stale += len(stale)
+        print(f"Found {len(stations)} stations with acceptable cached journeys, {len(stale)} stale and {len(uncached_stations)} without cached journeys")
+        return (stations, journeys, uncached_stations)
+
+    async def _find_properties_near(self, search_request: MatchingPropertySearchRequest, user: CurrentUser, stations: list[Station], journeys: dict[str, JourneySummary]) -> list[dict]:
+        if not stations:
+            return []
+        properties = await self.property_finder.find_properties_near_stations(search_request, user, [station.id for station in stations])
+        return [{**group, "journey_summary": journeys[group["station"]["id"]]} for group in properties]
+
+    async def _find_properties(self, search_request: MatchingPropertySearchRequest, user: CurrentUser) -> list[dict]:
         properties = await self.property_finder.find_properties_near_stations(search_request, user)
         print(f"Found properties around {len(properties)} stations")
-        requests = []
-        for group in properties:
-            requests.append(TrainJourneySearchRequest(
-                origin=group.station.id,
-                destination=search_request.destination,
-                start_time=search_request.start_time,
-                start_type=search_request.start_type,
-                return_time=search_request.return_time,
-                return_type=search_request.return_type,
-                day_of_week=search_request.day_of_week,
-                rail_card=search_request.rail_card
-            ))
-        journeys = await self.journey_finder.batch_search(requests)
-        for i in range(len(properties)):
-            station = properties[i].station
-            journey = journeys[i]
-            if journey == None or journey.outbound_details == None or journey.outbound_details.journey_time_details == None:
-                continue
-            has_acceptable_outbound_jourey = journey.outbound_details.journey_time_details.fastest_time <= search_request.max_journey_time
-            has_return_journey = (journey.return_details !=
-                                  None and journey.return_details.journey_time_details != None)
-            has_acceptable_return_journey = search_request.return_type == StartType.NONE or (
-                has_return_journey and journey.return_details.journey_time_details.fastest_time <= search_request.max_journey_time)
-            if has_acceptable_outbound_jourey and has_acceptable_return_journey:
-                results.append(PropertyStationGroupDetails(
-                    station=station, journey_summary=journey, properties=properties[i].properties))
-        return results
+        return properties
+
+    def _get_journey_request(self, search_request: MatchingPropertySearchRequest, station: Station | None) -> TrainJourneySearchRequest:
+        return TrainJourneySearchRequest(
+            origin="" if station == None else station.id,
+            destination=search_request.destination,
+            start_time=search_request.start_time,
+            start_type=search_request.start_type,
+            return_time=search_request.return_time,
+            return_type=search_request.return_type,
+            day_of_week=search_request.day_of_week,
+            rail_card=search_request.rail_card
+        )
+
+    def _is_acceptable_journey(self, search_request: MatchingPropertySearchRequest, journey: JourneySummary | None) -> bool:
+        if journey == None or journey.outbound_details == None or journey.outbound_details.journey_time_details == None:
+            return False
+        has_acceptable_outbound_jourey = journey.outbound_details.journey_time_details.fastest_time <= search_request.max_journey_time
+        has_return_journey = (journey.return_details !=
+                              None and journey.return_details.journey_time_details != None)
+        has_acceptable_return_journey = search_request.return_type == StartType.NONE or (
+            has_return_journey and journey.return_details.journey_time_details.fastest_time <= search_request.max_journey_time)
+        return has_acceptable_outbound_jourey and has_acceptable_return_journey
 
 
 type SearchInstance = Annotated[Search, Depends(Search)]
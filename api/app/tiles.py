@@ -0,0 +1,145 @@
+from .db import DBConnection, db_fetch_all
+from .cache import LRUCache
+from .property import SimplePropertySearchRequest, PROPERTY_FILTER_CONDITIONS, row_to_property, to_cursor, from_cursor
+from .enums import PropertyPreference
+from .user import CurrentUser
+from core.property_stations import PROPERTY_STATION_MAX_DISTANCE
+from pydantic import BaseModel, Field
+from typing import Optional, Annotated
+from fastapi import Depends
+from os import getenv
+import math
+
+_MAX_PRECISION = int(getenv("PROPERTY_TILE_MAX_PRECISION", "6"))
+_PAGE_SIZE = int(getenv("PROPERTY_TILE_PAGE_SIZE", "50"))
+_MAX_PAGE_SIZE = int(getenv("PROPERTY_TILE_MAX_PAGE_SIZE", "200"))
+# the last bucket of the bedroom histogram counts this many bedrooms or more
+_BEDROOM_BUCKETS = 5
+GEOHASH_PATTERN = r"^[0-9b-hjkmnp-z]{1,12}$"
+
+# tiles per filter set and bounds snapped to the tile grid
+property_tile_cache = LRUCache(
+    max_entries=int(getenv("PROPERTY_TILE_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(getenv("PROPERTY_TILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(getenv("PROPERTY_TILE_CACHE_TTL_SECONDS", "300")))
+
+
+class PropertyTileSearchRequest(SimplePropertySearchRequest):
+    # geohash length of the tiles
+    precision: int = Field(default=5, ge=1, le=_MAX_PRECISION)
+    # min longitude, min latitude, max longitude, max latitude
+    bounds: Optional[tuple[float, float, float, float]] = None
+    # only properties this close to a station
+    max_station_distance: Optional[int] = Field(default=None, le=PROPERTY_STATION_MAX_DISTANCE)
+    page_size: int = Field(default=_PAGE_SIZE, ge=1, le=_MAX_PAGE_SIZE)
+
+
+class PropertyTile(BaseModel):
+    geohash: str
+    bounds: tuple[float, float, float, float]
+    count: int
+    min_price: int
+    median_price: int
+    max_price: int
+    # properties per number of bedrooms, without the ones of unknown size
+    bedrooms: list[int]
+
+
+_TILE_CONDITIONS = f"""
+                (%(max_station_distance)s::integer is null or exists (
+                    select from property_station as ps
+                    where ps.property_id=p.id and ps.distance_m <= %(max_station_distance)s
+                ))
+                and {PROPERTY_FILTER_CONDITIONS}
+            """
+
+
+def _snap_bounds(bounds: tuple[float, float, float, float], precision: int) -> tuple[float, float, float, float]:
+    # out to the edges of the geohash cells they touch, so that every returned tile counts all of its properties
+    width = 360 / 2 ** ((5 * precision + 1) // 2)
+    height = 180 / 2 ** (5 * precision // 2)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return (max(-180, math.floor((min_lon + 180) / width) * width - 180), max(-90, math.floor((min_lat + 90) / height) * height - 90),
+            min(180, math.ceil((max_lon + 180) / width) * width - 180), min(90, math.ceil((max_lat + 90) / height) * height - 90))
+
+
+class PropertyTileFinder():
+    _BEDROOMS_HISTOGRAM = ", ".join([f"count(*) filter (where p.bedrooms = {bedrooms})" for bedrooms in range(
+        _BEDROOM_BUCKETS)] + [f"count(*) filter (where p.bedrooms >= {_BEDROOM_BUCKETS})"])
+    # bounds use an index on the geometry, the geography index would compare great circles instead of the longitude and latitude box
+    _TILES_QUERY_TEMPLATE = f"""
+                select tiles.geohash, ST_XMin(cell), ST_YMin(cell), ST_XMax(cell), ST_YMax(cell),
+                tiles.count, tiles.min_price, tiles.median_price, tiles.max_price, tiles.bedrooms
+                from (
+                    select
+                    ST_GeoHash(p.location::geometry, %(precision)s) as "geohash",
+                    count(*) as "count",
+                    min(p.price) as "min_price",
+                    round(percentile_cont(0.5) within group (order by p.price))::integer as "median_price",
+                    max(p.price) as "max_price",
+                    array[{_BEDROOMS_HISTOGRAM}] as "bedrooms"
+                    from properties as p
+                    left outer join property_preferences as pref
+                    on pref.user_id=%(username)s and pref.property_id=p.id
+                    where {{bounds_condition}}
+                    and {_TILE_CONDITIONS}
+                    group by 1
+                ) as tiles
+                cross join lateral ST_GeomFromGeoHash(tiles.geohash) as cell
+                order by tiles.geohash
+            """
+    _ALL_TILES_QUERY_TEMPLATE = _TILES_QUERY_TEMPLATE.format(bounds_condition="true")
+    _TILES_IN_BOUNDS_QUERY_TEMPLATE = _TILES_QUERY_TEMPLATE.format(
+        bounds_condition="p.location::geometry && ST_MakeEnvelope(%(min_lon)s, %(min_lat)s, %(max_lon)s, %(max_lat)s, 4326)")
+    # the bounding box of the cell uses the location index, the geohash keeps properties on an edge in one tile
+    _TILE_PROPERTIES_QUERY_TEMPLATE = f"""
+                select
+                p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), p.address, p.price, p.bedrooms, p.bathrooms,
+                pref.preference
+                from properties as p
+                left outer join property_preferences as pref
+                on pref.user_id=%(username)s and pref.property_id=p.id
+                where p.location && ST_GeomFromGeoHash(%(geohash)s::text)::geography
+                and ST_GeoHash(p.location::geometry, length(%(geohash)s::text)) = %(geohash)s::text
+                and (%(after_price)s::integer is null or (p.price, p.id) > (%(after_price)s, %(after_id)s::bigint))
+                and {_TILE_CONDITIONS}
+                order by p.price, p.id
+                limit %(limit)s
+            """
+
+    def __init__(self, connection: DBConnection):
+        self.connection = connection
+
+    async def find_tiles(self, request: PropertyTileSearchRequest, user: CurrentUser) -> list[dict]:
+        args = request.model_dump(exclude={"bounds", "page_size"})
+        args["username"] = user.username
+        query = PropertyTileFinder._ALL_TILES_QUERY_TEMPLATE
+        if request.bounds != None:
+            args["min_lon"], args["min_lat"], args["max_lon"], args["max_lat"] = _snap_bounds(request.bounds, request.precision)
+            query = PropertyTileFinder._TILES_IN_BOUNDS_QUERY_TEMPLATE
+        # hidden properties are left out, so the tiles are cached per user
+        key = tuple(sorted(args.items()))
+        tiles = property_tile_cache.get(key)
+        if tiles == None:
+            rows = await db_fetch_all(self.connection, query, args, prepare=True)
+            tiles = [{"geohash": row[0], "bounds": (row[1], row[2], row[3], row[4]), "count": row[5], "min_price": row[6],
+                      "median_price": row[7], "max_price": row[8], "bedrooms": row[9]} for row in rows]
+            property_tile_cache.put(key, tiles)
+        return tiles
+
+    async def find_tile_properties(self, request: PropertyTileSearchRequest, user: CurrentUser, geohash: str, cursor: str | None = None) -> dict:
+        args = request.model_dump(exclude={"bounds"})
+        args["username"] = user.username
+        args["geohash"] = geohash
+        args["after_price"], args["after_id"] = from_cursor(cursor, int, int)
+        args["limit"] = request.page_size + 1
+        rows = await db_fetch_all(self.connection, PropertyTileFinder._TILE_PROPERTIES_QUERY_TEMPLATE, args, prepare=True)
+        properties = [row_to_property(row, row[7] == PropertyPreference.STAR.name)
+                      for row in rows[:request.page_size]]
+        if len(rows) > request.page_size:
+            return {"properties": properties, "total": None, "next_cursor": to_cursor(rows[request.page_size - 1][4], rows[request.page_size - 1][0])}
+        return {"properties": properties, "total": None, "next_cursor": None}
+
+
+type PropertyTileFinderInstance = Annotated[PropertyTileFinder, Depends(
+    PropertyTileFinder)]
@@ -0,0 +1,9 @@
+from fastapi import Request, Depends
+from typing import Annotated
+from core.upstream import TokenBucket, UpstreamClient, get_journey_planner_client
+
+
+async def journey_planner_client(request: Request) -> UpstreamClient:
+    return request.state.journey_planner_client
+type JourneyPlannerClient = Annotated[UpstreamClient, Depends(
+    journey_planner_client)]
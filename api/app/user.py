@@ -1,20 +1,31 @@
 from pydantic import BaseModel
 from typing import Annotated
 from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
 from pwdlib import PasswordHash
 import jwt
 from jwt.exceptions import InvalidTokenError
 from .db import DBConnection, db_fetch_one
+from .cache import LRUCache
 from datetime import datetime, timedelta
 from os import getenv
+import hmac
 
 _password_hash = PasswordHash.recommended()
 _oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
+_admin_token_scheme = APIKeyHeader(name="X-Admin-Token", auto_error=False)
 
 _SECRET_KEY = getenv("SECRET_KEY")
 _ALGORITHM = "HS256"
 _DUMMY_HASH = _password_hash.hash("dummy")
+# the internal endpoints are not served unless this is set
+_ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+
+# users whose token was already checked against the users table, a removed user
+# keeps access for at most the ttl unless invalidate_user is called
+user_cache = LRUCache(
+    max_entries=int(getenv("USER_CACHE_MAX_ENTRIES", "10000")),
+    ttl=float(getenv("USER_CACHE_TTL_SECONDS", "60")))
 
 
 class User(BaseModel):
@@ -40,10 +51,30 @@ async def get_current_user(db_connection: DBConnection, token: Annotated[str, De
         username = sub.removeprefix("user.")
     except InvalidTokenError:
         raise credentials_exception
-    db_user = await db_fetch_one(db_connection, "select username from users where username=%s", [username])
+    user = user_cache.get(username)
+    if user != None:
+        return user
+    # the connection is the one the endpoint uses, only a cache miss queries it
+    db_user = await db_fetch_one(db_connection, "select username from users where username=%s", [username], prepare=True)
     if not db_user:
         raise credentials_exception
-    return User(username=db_user[0])
+    user = User(username=db_user[0])
+    user_cache.put(username, user)
+    return user
+
+
+async def require_admin(token: Annotated[str | None, Depends(_admin_token_scheme)]) -> None:
+    if not _ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if token == None or not hmac.compare_digest(token.encode(), _ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
+
+
+def invalidate_user(username: str | None = None) -> None:
+    if username == None:
+        user_cache.clear()
+    else:
+        user_cache.invalidate(username)
 
 
 def verify_password(plain: str, hashed: str) -> bool:
@@ -0,0 +1,72 @@
+# Measures listing crawler pages/sec against the offline listing stub at
+# different concurrency limits, without a database, e.g.
+#   PYTHONPATH=. python -m bench.crawler_throughput --stations 200 --concurrency 1 4 16
+from aiohttp import web
+from bench.listing_stub import create_app, _create_listings, _BOUNDS
+from core.properties import ListingCrawler, CrawlStats, plan_search_tiles
+from core.upstream import UpstreamClient
+import argparse
+import asyncio
+import random
+import time
+
+
+async def _drain(queue: asyncio.Queue) -> None:
+    while True:
+        await queue.get()
+        queue.task_done()
+
+
+async def main(args) -> None:
+    stub = create_app(_create_listings(args.listings), args.latency,
+                      args.max_in_flight, args.error_rate)
+    runner = web.AppRunner(stub)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", args.port).start()
+    url = f"http://localhost:{args.port}/api/property-search/listing/search"
+    generator = random.Random(2)
+    stations = [(generator.uniform(_BOUNDS[0] + 0.05, _BOUNDS[2] - 0.05), generator.uniform(_BOUNDS[1] + 0.05, _BOUNDS[3] - 0.05))
+                for _ in range(args.stations)]
+    tiles = plan_search_tiles(stations, args.radius)
+    print(f"stations={len(stations)} tiles={len(tiles)}")
+    try:
+        for concurrency in args.concurrency:
+            client = UpstreamClient(max_concurrency=concurrency, requests_per_second=args.rate,
+                                    burst=concurrency, backoff_base=0.05, max_retries=6)
+            await client.open()
+            queue = asyncio.Queue(1000)
+            drain = asyncio.create_task(_drain(queue))
+            stats = CrawlStats()
+            crawler = ListingCrawler(
+                client, args.max_price, queue, stats, base_url=url)
+            requests_before = stub["requests"]
+            start_time = time.time()
+            try:
+                await crawler.crawl([(tile, 0) for tile in tiles], concurrency)
+            finally:
+                drain.cancel()
+                await client.close()
+            elapsed = time.time() - start_time
+            print(f"concurrency={concurrency} elapsed={elapsed:.2f}s pages={stats.pages} pages_per_second={stats.pages / elapsed:.1f} "
+                  f"tiles={stats.tiles} split_tiles={stats.split_tiles} failed_tiles={stats.failed_tiles} listings={len(crawler.seen_ids)} "
+                  f"duplicates={stats.duplicates} upstream_requests={stub['requests'] - requests_before} retries={client.retries}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--listings", type=int, default=50000)
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--radius", type=int, default=3500)
+    parser.add_argument("--max-price", type=int, default=2500)
+    parser.add_argument("--concurrency", type=int,
+                        nargs="+", default=[1, 4, 16])
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests per second, 0 disables the rate limit")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-in-flight", type=int, default=12,
+                        help="stub returns 503 above this many concurrent requests")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+# Checks that journey cache misses on /search/train-journey do not stall other
+# requests. Starts the journey planner stub with a slow response, then polls a
+# cheap endpoint while concurrent misses are in flight, e.g.
+#   PYTHONPATH=api:. python -m bench.event_loop_responsiveness --api http://localhost:8080
+# with the api running against JOURNEY_PLANNER_ENDPOINT=http://<host>:8092/journey-planner and
+# ADMIN_TOKEN set to the token of the api
+from aiohttp import web, ClientSession
+from bench.journey_planner_stub import create_app
+from statistics import median, quantiles
+from os import getenv
+import argparse
+import asyncio
+import time
+
+
+async def _poll(session: ClientSession, url: str, admin_token: str, stop: asyncio.Event, interval: float) -> list[float]:
+    latencies = []
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        async with session.get(url, headers={"X-Admin-Token": admin_token}) as response:
+            await response.read()
+        latencies.append(time.perf_counter() - start_time)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def _search(session: ClientSession, url: str, origin: str, i: int) -> int:
+    # a distinct start time per request so that every search is a cache miss
+    body = {
+        "origin": origin,
+        "destination": "182",
+        "start_time": f"{6 + i // 3600 % 12:02d}:{i // 60 % 60:02d}:{i % 60:02d}",
+        "start_type": "ARRIVE",
+        "return_time": None,
+        "return_type": None,
+        "day_of_week": 2,
+        "rail_card": "YNG"
+    }
+    async with session.post(url, json=body) as response:
+        await response.read()
+        return response.status
+
+
+async def _measure(session: ClientSession, args, misses: int, offset: int) -> tuple[list[float], float]:
+    stop = asyncio.Event()
+    poller = asyncio.create_task(_poll(
+        session, f"{args.api}/internal/journey-cache/stats", args.admin_token, stop, args.interval))
+    start_time = time.time()
+    if misses:
+        await asyncio.gather(*[_search(session, f"{args.api}/search/train-journey", args.origin, offset + i) for i in range(misses)])
+    else:
+        await asyncio.sleep(args.latency)
+    elapsed = time.time() - start_time
+    stop.set()
+    return await poller, elapsed
+
+
+def _report(label: str, latencies: list[float], elapsed: float) -> None:
+    percentiles = quantiles(latencies, n=100)
+    print(f"{label}: elapsed={elapsed:.2f}s polls={len(latencies)} p50={median(latencies)*1000:.1f}ms "
+          f"p99={percentiles[98]*1000:.1f}ms max={max(latencies)*1000:.1f}ms")
+
+
+async def main(args) -> None:
+    runner = web.AppRunner(create_app(args.latency))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", args.port).start()
+    try:
+        async with ClientSession() as session:
+            _report("idle", *await _measure(session, args, 0, 0))
+            offset = int(time.time()) % 10000 * 10
+            for misses in args.misses:
+                _report(f"misses={misses}", *await _measure(session, args, misses, offset))
+                offset += misses
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api", default="http://localhost:8080")
+    parser.add_argument("--origin", default="CBG",
+                        help="an existing station id")
+    parser.add_argument("--port", type=int, default=8092)
+    parser.add_argument("--latency", type=float, default=2,
+                        help="seconds the stub takes to answer each journey search")
+    parser.add_argument("--misses", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--admin-token", default=getenv("ADMIN_TOKEN", ""))
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,73 @@
+# Compares the per-key executemany cache lookup with the single unnest lookup
+# used by JourneyFinder.batch_search. Needs the POSTGRES_* env vars of a
+# database created from tables.sql, synthetic rows are rolled back afterwards.
+#   PYTHONPATH=api:. python -m bench.journey_cache_lookup --stations 50 500 5000
+from core.db import get_conn_str, db_fetch_all, db_execute_many, db_execute_many_fetch
+from app.journey import JourneyFinder, get_journey_key, response_to_summary, TrainJourneySearchRequest, TrainJourneySearchResponse, StartType, DayOfWeek
+from bench.journey_planner_stub import _create_journeys
+from datetime import datetime
+from psycopg import AsyncConnection
+import argparse
+import asyncio
+import string
+import time
+
+_PER_KEY_QUERY_TEMPLATE = """
+            select %s as "search_id", checked_at, data, s.id, s.name, ST_X(s.location::geometry), ST_Y(s.location::geometry)
+            from journeys as "j" join stations as "s"
+            on s.id=j.origin
+            where origin=%s and destination=%s and start_time=%s and start_type=%s and return_time=%s and return_type=%s and day_of_week=%s and rail_card=%s
+            """
+
+
+def _station_id(i: int) -> str:
+    # lower case so that synthetic ids never collide with real CRS codes
+    alphabet = string.ascii_lowercase + string.digits
+    return alphabet[i // 1296 % 36] + alphabet[i // 36 % 36] + alphabet[i % 36]
+
+
+async def _seed(connection: AsyncConnection, finder: JourneyFinder, count: int) -> list[TrainJourneySearchRequest]:
+    await db_execute_many(connection, "insert into stations (id, location, name) values (%s, 'point(0 51)', %s)",
+                          [[_station_id(i), f"bench {i}"] for i in range(count)])
+    requests = []
+    to_cache = []
+    for i in range(count):
+        request = TrainJourneySearchRequest(origin=_station_id(i), destination="182", start_time="09:15:00", start_type=StartType.ARRIVE,
+                                            return_time="17:30:00", return_type=StartType.DEPART, day_of_week=DayOfWeek.TUE, rail_card="YNG")
+        response = TrainJourneySearchResponse(checked_at=datetime.now(), data={
+            "outwardJourneys": _create_journeys("2026-10-20T09:15:00Z", 6, "OUTWARD"),
+            "inwardJourneys": _create_journeys("2026-10-20T17:30:00Z", 6, "INWARD")})
+        requests.append(request)
+        to_cache.append((request, response, response_to_summary(response)))
+    await finder._cache_journey(to_cache)
+    return requests
+
+
+async def _time(repeats: int, lookup) -> tuple[float, int]:
+    start_time = time.time()
+    for _ in range(repeats):
+        rows = await lookup()
+    return (time.time() - start_time) / repeats, len(rows)
+
+
+async def main(args) -> None:
+    async with await AsyncConnection.connect(get_conn_str()) as connection:
+        finder = JourneyFinder(connection, None, None)
+        for count in args.stations:
+            requests = await _seed(connection, finder, count)
+            per_key_args = [[i, *get_journey_key(requests[i])]
+                            for i in range(count)]
+            per_key, per_key_rows = await _time(args.repeats, lambda: db_execute_many_fetch(
+                connection, _PER_KEY_QUERY_TEMPLATE, per_key_args))
+            unnest, unnest_rows = await _time(args.repeats, lambda: db_fetch_all(
+                connection, JourneyFinder._GET_CACHED_JOURNEYS_QUERY_TEMPLATE, finder._get_journey_key_arrays(requests)))
+            print(f"stations={count} per_key={per_key*1000:.1f}ms ({per_key_rows} rows) unnest={unnest*1000:.1f}ms ({unnest_rows} rows) speedup={per_key/unnest:.1f}x")
+            await connection.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, nargs="+",
+                        default=[50, 500, 5000])
+    parser.add_argument("--repeats", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+# Local stand-in for the National Rail journey planner so the upstream client
+# can be exercised offline, e.g.
+#   python -m bench.journey_planner_stub --port 8090 --latency 0.2 --max-in-flight 16
+# then run the api with JOURNEY_PLANNER_ENDPOINT=http://localhost:8090/journey-planner
+from aiohttp import web
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import random
+
+
+def _create_journeys(travel_time: str, count: int, direction: str) -> list[dict]:
+    journeys = []
+    departure = datetime.fromisoformat(travel_time.removesuffix("Z"))
+    for i in range(count):
+        duration = random.randint(20, 120)
+        journeys.append({
+            "duration": f"{duration // 60}h {duration % 60}m" if duration >= 60 else f"{duration}m",
+            "timetable": {"scheduled": {"departure": (departure + timedelta(minutes=15 * i)).strftime("%Y-%m-%dT%H:%M:%SZ")}},
+            "legs": [{}] * random.randint(1, 3),
+            "fares": [
+                {"totalPrice": random.randint(500, 5000),
+                 "typeDescription": "Anytime Day", "direction": direction},
+                {"totalPrice": random.randint(1000, 9000),
+                 "typeDescription": "Off-Peak Return", "direction": "RETURN"}
+            ]
+        })
+    return journeys
+
+
+def create_app(latency: float = 0.1, max_in_flight: int | None = None, journeys: int = 6) -> web.Application:
+    app = web.Application()
+    app["in_flight"] = 0
+    app["requests"] = 0
+    app["throttled"] = 0
+
+    async def journey_planner(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        if max_in_flight != None and app["in_flight"] >= max_in_flight:
+            app["throttled"] += 1
+            return web.Response(status=429, text="<html>Too many requests</html>", content_type="text/html", headers={"Retry-After": "1"})
+        app["in_flight"] += 1
+        try:
+            body = await request.json()
+            await asyncio.sleep(latency)
+            data = {"outwardJourneys": _create_journeys(
+                body["outwardTime"]["travelTime"], journeys, "OUTWARD")}
+            if "inwardTime" in body:
+                data["inwardJourneys"] = _create_journeys(
+                    body["inwardTime"]["travelTime"], journeys, "INWARD")
+            return web.json_response(data)
+        finally:
+            app["in_flight"] -= 1
+
+    app.router.add_post("/journey-planner", journey_planner)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.max_in_flight), port=args.port)
@@ -0,0 +1,88 @@
+# Offline stand-in for the listing search api used by the property crawler,
+# serving synthetic listings spread over London, e.g.
+#   python -m bench.listing_stub --port 8094 --listings 50000 --latency 0.1
+# then run the crawler with PROPERTY_LISTING_ENDPOINT=http://localhost:8094/api/property-search/listing/search
+from aiohttp import web
+from bisect import bisect_left, bisect_right
+import argparse
+import asyncio
+import json
+import polyline
+import random
+
+_PAGE_SIZE = 24
+_BOUNDS = (-0.55, 51.25, 0.35, 51.75)
+
+
+def _create_listings(count: int, seed: int = 1) -> list[dict]:
+    generator = random.Random(seed)
+    listings = []
+    for i in range(count):
+        listings.append({
+            "id": 100000000 + i,
+            "location": {"longitude": generator.uniform(_BOUNDS[0], _BOUNDS[2]), "latitude": generator.uniform(_BOUNDS[1], _BOUNDS[3])},
+            "displayAddress": f"{i} Stub Street, London",
+            "price": {"amount": generator.randint(700, 5000), "frequency": generator.choice(["monthly", "monthly", "weekly"])},
+            "bedrooms": generator.randint(0, 5),
+            "bathrooms": generator.randint(1, 3)
+        })
+    listings.sort(key=lambda listing: listing["location"]["longitude"])
+    return listings
+
+
+def _get_bounds(location_identifier: str) -> tuple[float, float, float, float]:
+    points = polyline.decode(json.loads(
+        location_identifier.split("^", 1)[1])["polylines"])
+    latitudes = [point[0] for point in points]
+    longitudes = [point[1] for point in points]
+    return (min(longitudes), min(latitudes), max(longitudes), max(latitudes))
+
+
+def create_app(listings: list[dict], latency: float = 0.05, max_in_flight: int | None = None, error_rate: float = 0, max_results: int = 1000) -> web.Application:
+    app = web.Application()
+    app["in_flight"] = 0
+    app["requests"] = 0
+    app["throttled"] = 0
+    longitudes = [listing["location"]["longitude"] for listing in listings]
+
+    async def search(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        if (max_in_flight != None and app["in_flight"] >= max_in_flight) or random.random() < error_rate:
+            app["throttled"] += 1
+            return web.Response(status=503, text="<html>Service unavailable</html>", content_type="text/html")
+        app["in_flight"] += 1
+        try:
+            await asyncio.sleep(latency)
+            bounds = _get_bounds(request.query["locationIdentifier"])
+            max_price = int(request.query.get("maxPrice", "1000000"))
+            index = int(request.query.get("index", "0"))
+            matches = [listing for listing in listings[bisect_left(longitudes, bounds[0]):bisect_right(longitudes, bounds[2])]
+                       if bounds[1] <= listing["location"]["latitude"] <= bounds[3]
+                       and listing["price"]["amount"] * (4 if listing["price"]["frequency"] == "weekly" else 1) <= max_price]
+            # like the real api, paging stops at the result cap whatever the result count
+            available = min(len(matches), max_results)
+            data = {
+                "resultCount": f"{len(matches):,}",
+                "properties": matches[index:min(index + _PAGE_SIZE, available)],
+                "pagination": {}
+            }
+            if index + _PAGE_SIZE < available:
+                data["pagination"]["next"] = str(index + _PAGE_SIZE)
+            return web.json_response(data)
+        finally:
+            app["in_flight"] -= 1
+
+    app.router.add_get("/api/property-search/listing/search", search)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8094)
+    parser.add_argument("--listings", type=int, default=50000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+    web.run_app(create_app(_create_listings(args.listings), args.latency,
+                args.max_in_flight, args.error_rate), port=args.port)
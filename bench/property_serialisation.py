@@ -0,0 +1,75 @@
+# Compares encoding property search rows with a pydantic model per row, then
+# validated and serialised against the response_model as FastAPI does, with the
+# plain dict + orjson path used by PropertyFinder. Needs no database, e.g.
+#   PYTHONPATH=api:. SECRET_KEY=bench python -m bench.property_serialisation --rows 1000 20000 100000
+from app.property import PropertyStationGroup, Property, Station, row_to_property, row_to_station
+from app.encoding import to_json
+from pydantic import TypeAdapter
+from statistics import median
+import argparse
+import json
+import random
+import time
+
+
+def _create_rows(count: int, stations: int) -> list[tuple]:
+    # the columns of PropertyFinder._SEARCH_QUERY_TEMPLATE, ordered by station
+    rows = []
+    for i in range(count):
+        station = i * stations // count
+        rows.append((i, random.uniform(-0.5, 0.3), random.uniform(51.3, 51.7), f"{i} Bench Street, London",
+                     random.randint(800, 4000), random.randint(0, 4), random.randint(1, 2),
+                     f"s{station:02d}", f"Station {station}", random.uniform(-0.5, 0.3), random.uniform(51.3, 51.7),
+                     random.choice([None, None, "STAR"]), count // stations))
+    return rows
+
+
+def _encode_models(rows: list[tuple], adapter: TypeAdapter) -> bytes:
+    # a Station and a Property model per row, the price coerced from a string
+    groups = {}
+    for row in rows:
+        station = Station(id=str(row[7]), name=str(row[8]), location=(row[9], row[10]))
+        groups.setdefault(station.id, (station, row[12], []))[2].append(
+            Property(id=str(row[0]), location=(row[1], row[2]), address=str(row[3]), price=str(row[4]), bedrooms=row[5], bathrooms=row[6], star=row[11] == "STAR"))
+    results = [PropertyStationGroup(station=group[0], properties=group[2], total=group[1])
+               for group in groups.values()]
+    return adapter.dump_json(adapter.validate_python(results))
+
+
+def _encode_dicts(rows: list[tuple]) -> bytes:
+    groups = {}
+    for row in rows:
+        group = groups.get(row[7])
+        if group == None:
+            group = groups[row[7]] = {"station": row_to_station(
+                row), "properties": [], "total": row[12], "next_cursor": None}
+        group["properties"].append(row_to_property(row, row[11] == "STAR"))
+    return to_json(list(groups.values()))
+
+
+def _time(encode, repeat: int) -> tuple[float, bytes]:
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        encoded = encode()
+        timings.append(time.perf_counter() - start_time)
+    return median(timings), encoded
+
+
+def main(args) -> None:
+    adapter = TypeAdapter(list[PropertyStationGroup])
+    for count in args.rows:
+        rows = _create_rows(count, args.stations)
+        models, models_json = _time(lambda: _encode_models(rows, adapter), args.repeat)
+        dicts, dicts_json = _time(lambda: _encode_dicts(rows), args.repeat)
+        assert json.loads(models_json) == json.loads(dicts_json)
+        print(f"rows={count}: models={models*1000:.1f}ms dicts={dicts*1000:.1f}ms "
+              f"speedup={models / dicts:.1f}x bytes={len(dicts_json)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 20000, 100000])
+    parser.add_argument("--stations", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
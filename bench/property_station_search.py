@@ -0,0 +1,83 @@
+# Compares the property search with ST_DWithin between all properties and
+# stations against the lookup in the pre-joined property_station table. Needs
+# the POSTGRES_* env vars of a database created from tables.sql with stations,
+# synthetic listings use negative ids and are deleted afterwards.
+#   PYTHONPATH=api:. SECRET_KEY=bench python -m bench.property_station_search --rows 100000 250000
+from core.db import get_db_connection_pool, db_execute, db_fetch_all
+from core.properties import get_property_writer, store_properties
+from app.property import PropertyFinder, PROPERTY_FILTER_CONDITIONS
+from bench.property_writers import _create_listings
+from statistics import median
+import argparse
+import asyncio
+import time
+
+# the search before property_station
+_SPATIAL_JOIN_QUERY_TEMPLATE = f"""
+                select
+                p.id, ST_X(p.location::geometry), ST_Y(p.location::geometry), address, price, bedrooms, bathrooms,
+                s.id, s.name, ST_X(s.location::geometry), ST_Y(s.location::geometry),
+                pref.preference
+                from properties as p join stations as s
+                on ST_DWithin(p.location, s.location, %(max_station_distance)s)
+                left outer join property_preferences as pref
+                on pref.user_id=%(username)s and pref.property_id=p.id
+                where
+                (%(station_ids)s::text[] is null or s.id = any(%(station_ids)s))
+                and {PROPERTY_FILTER_CONDITIONS}
+            """
+
+
+async def _time_query(connection, sql: str, args: dict, repeat: int) -> tuple[float, int]:
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        rows = await db_fetch_all(connection, sql, args)
+        timings.append(time.perf_counter() - start_time)
+    return median(timings), len(rows)
+
+
+async def main(args) -> None:
+    db_pool = get_db_connection_pool()
+    await db_pool.open()
+    try:
+        async with db_pool.connection() as connection:
+            station_ids = [row[0] for row in await db_fetch_all(connection, "select id from stations order by id limit %s", [args.stations])]
+        written = 0
+        for rows in args.rows:
+            listings = _create_listings(rows)[written:]
+            writer = get_property_writer("copy")
+            start_time = time.time()
+            async with db_pool.connection() as connection:
+                for i in range(0, len(listings), args.batch_size):
+                    await store_properties(connection, listings[i:i+args.batch_size], writer)
+                await db_execute(connection, "analyze properties")
+                await db_execute(connection, "analyze property_station")
+            written = rows
+            print(f"rows={rows}: wrote {len(listings)} listings with their station distances in {time.time() - start_time:.1f}s")
+            for label, ids in [("all stations", None), (f"{len(station_ids)} stations", station_ids)]:
+                query_args = {"max_station_distance": args.distance, "username": "bench", "station_ids": ids,
+                              "min_price": None, "max_price": args.max_price, "min_bedrooms": None, "max_bedrooms": None,
+                              "min_bathrooms": None, "max_bathrooms": None}
+                async with db_pool.connection() as connection:
+                    spatial_join, spatial_join_rows = await _time_query(connection, _SPATIAL_JOIN_QUERY_TEMPLATE, query_args, args.repeat)
+                    lookup, lookup_rows = await _time_query(connection, PropertyFinder._SEARCH_BY_NEAR_STATIONS_QUERY_TEMPLATE if ids == None else PropertyFinder._SEARCH_BY_STATION_IDS_QUERY_TEMPLATE, query_args, args.repeat)
+                print(f"rows={rows} {label}: spatial_join={spatial_join*1000:.0f}ms ({spatial_join_rows} rows) "
+                      f"property_station={lookup*1000:.0f}ms ({lookup_rows} rows) speedup={spatial_join / lookup:.1f}x")
+    finally:
+        async with db_pool.connection() as connection:
+            await db_execute(connection, "delete from properties where id < 0")
+        await db_pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000],
+                        help="total synthetic listings, ascending, each step adds to the previous")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--stations", type=int, default=20,
+                        help="stations in the station id search")
+    parser.add_argument("--distance", type=int, default=2000)
+    parser.add_argument("--max-price", type=int, default=2500)
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
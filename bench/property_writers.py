@@ -0,0 +1,72 @@
+# Compares rows/sec of the executemany and COPY property writers with N
+# concurrent writers. Needs the POSTGRES_* env vars of a database created from
+# tables.sql, synthetic listings use negative ids and are deleted afterwards.
+#   PYTHONPATH=. python -m bench.property_writers --rows 100000 --writers 1 4
+from core.db import get_db_connection_pool, db_execute
+from core.properties import get_property_writer, store_properties
+import argparse
+import asyncio
+import random
+import time
+
+
+def _create_listings(count: int) -> list[dict]:
+    listings = []
+    for i in range(count):
+        listings.append({
+            "id": -1 - i,
+            "location": {"longitude": random.uniform(-0.5, 0.3), "latitude": random.uniform(51.3, 51.7)},
+            "displayAddress": f"{i} Bench Street, London",
+            "price": {"amount": random.randint(800, 4000), "frequency": random.choice(["monthly", "weekly"])},
+            "bedrooms": random.randint(0, 4),
+            "bathrooms": random.randint(1, 2)
+        })
+    return listings
+
+
+async def _write(db_pool, writer_name: str, batches: list[list[dict]], writers: int) -> float:
+    writer = get_property_writer(writer_name)
+    queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+
+    async def run_writer():
+        while not queue.empty():
+            batch = queue.get_nowait()
+            async with db_pool.connection() as connection:
+                await store_properties(connection, batch, writer)
+
+    start_time = time.time()
+    await asyncio.gather(*[run_writer() for _ in range(writers)])
+    return time.time() - start_time
+
+
+async def main(args) -> None:
+    db_pool = get_db_connection_pool()
+    await db_pool.open()
+    listings = _create_listings(args.rows)
+    batches = [listings[i:i+args.batch_size]
+               for i in range(0, len(listings), args.batch_size)]
+    try:
+        for writers in args.writers:
+            for writer_name in ["executemany", "copy"]:
+                # inserts, then the same unchanged listings, then every price changed
+                inserted = await _write(db_pool, writer_name, batches, writers)
+                unchanged = await _write(db_pool, writer_name, batches, writers)
+                for listing in listings:
+                    listing["price"]["amount"] += 1
+                updated = await _write(db_pool, writer_name, batches, writers)
+                print(f"writer={writer_name} writers={writers} rows={args.rows} insert={args.rows / inserted:.0f}rows/s "
+                      f"unchanged={args.rows / unchanged:.0f}rows/s update={args.rows / updated:.0f}rows/s")
+                async with db_pool.connection() as connection:
+                    await db_execute(connection, "delete from properties where id < 0")
+    finally:
+        await db_pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 4])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,57 @@
+# Compares the size and the decode time of the negotiated response formats of
+# /search/near-stations on a synthetic result, uncompressed, gzip and brotli
+# compressed at the CompressionMiddleware defaults. Needs no database, e.g.
+#   PYTHONPATH=api:. SECRET_KEY=bench python -m bench.response_formats --rows 20000
+from app.encoding import _ENCODERS
+from app.property import row_to_property, row_to_station
+from bench.property_serialisation import _create_rows
+from statistics import median
+import argparse
+import brotli
+import gzip
+import json
+import msgpack
+import time
+
+
+def _group(rows: list[tuple]) -> dict:
+    groups = {}
+    for row in rows:
+        group = groups.get(row[7])
+        if group == None:
+            group = groups[row[7]] = {"station": row_to_station(
+                row), "properties": [], "total": row[12], "next_cursor": None}
+        group["properties"].append(row_to_property(row, row[11] == "STAR"))
+    return {"groups": list(groups.values()), "next_cursor": None}
+
+
+def _time(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return median(timings)
+
+
+def main(args) -> None:
+    content = _group(_create_rows(args.rows, args.stations))
+    for media_type, encode in _ENCODERS.items():
+        encoded = encode(content)
+        decode = msgpack.unpackb if "msgpack" in media_type else json.loads
+        encode_time = _time(lambda: encode(content), args.repeat)
+        decode_time = _time(lambda: decode(encoded), args.repeat)
+        gzipped = gzip.compress(encoded, args.gzip_level)
+        brotli_compressed = brotli.compress(encoded, quality=args.brotli_quality)
+        print(f"{media_type}: bytes={len(encoded)} gzip={len(gzipped)} br={len(brotli_compressed)} "
+              f"encode={encode_time*1000:.1f}ms decode={decode_time*1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--stations", type=int, default=50)
+    parser.add_argument("--gzip-level", type=int, default=6)
+    parser.add_argument("--brotli-quality", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
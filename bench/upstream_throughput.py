@@ -0,0 +1,54 @@
+# Measures journey planner client throughput against the local stub, e.g.
+#   PYTHONPATH=api python -m bench.upstream_throughput --requests 500
+from aiohttp import web
+from core.upstream import UpstreamClient
+from bench.journey_planner_stub import create_app
+import argparse
+import asyncio
+import time
+
+_BODY = {
+    "origin": {"crs": "CBG", "group": False},
+    "destination": {"crs": "182", "group": True},
+    "outwardTime": {"travelTime": "2026-10-20T09:15:00Z", "type": "ARRIVE"},
+    "inwardTime": {"travelTime": "2026-10-20T17:30:00Z", "type": "DEPART"}
+}
+
+
+async def _run(client: UpstreamClient, url: str, requests: int) -> tuple[float, int]:
+    await client.open()
+    try:
+        start_time = time.time()
+        results = await asyncio.gather(*[client.post_json(url, _BODY) for _ in range(requests)])
+        return (time.time() - start_time, sum(1 for result in results if result != None))
+    finally:
+        await client.close()
+
+
+async def main(args) -> None:
+    runner = web.AppRunner(create_app(args.latency, args.max_in_flight))
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", args.port).start()
+    url = f"http://localhost:{args.port}/journey-planner"
+    try:
+        for concurrency in args.concurrency:
+            client = UpstreamClient(
+                max_concurrency=concurrency, requests_per_second=args.rate, burst=concurrency, backoff_base=0.05)
+            elapsed, succeeded = await _run(client, url, args.requests)
+            print(f"concurrency={concurrency} rate={args.rate} requests={args.requests} succeeded={succeeded} retries={client.retries} "
+                  f"elapsed={elapsed:.2f}s throughput={args.requests / elapsed:.1f}req/s")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests per second, 0 disables the rate limit")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-in-flight", type=int, default=32,
+                        help="stub returns 429 above this many concurrent requests")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,236 @@
+from .db import db_execute, db_execute_many, db_fetch_one, db_fetch_all
+from datetime import datetime, timedelta
+from enum import Enum
+from pydantic import BaseModel
+from os import getenv
+
+
+class CrawlStatus(str, Enum):
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    SPLIT = "SPLIT"
+    COMPLETE = "COMPLETE"
+    FAILED = "FAILED"
+
+
+# an interrupted or failed run started this recently is resumed, an older one is closed and a new run started
+_RESUME_FOR = timedelta(hours=float(getenv("PROPERTY_CRAWL_RESUME_HOURS", "24")))
+
+
+def _is_resumable(status: CrawlStatus, started_at: datetime, resume_for: timedelta) -> bool:
+    return status in (CrawlStatus.RUNNING, CrawlStatus.FAILED) and started_at > datetime.now() - resume_for
+
+
+class CrawledPage():
+    def __init__(self, tile: str, index: int, next_index: int, last: bool, listing_ids: list[int], properties: list[dict]):
+        self.tile = tile
+        self.index = index
+        self.next_index = next_index
+        self.last = last
+        self.listing_ids = listing_ids
+        self.properties = properties
+
+
+class CrawlRun(BaseModel):
+    id: int
+    started_at: datetime
+    finished_at: datetime | None
+    status: CrawlStatus
+    max_price: int
+    radius: int
+    pages: int
+    listings: int
+    rows_written: int
+    tiles: dict[CrawlStatus, int]
+
+
+def tile_to_key(tile: tuple[float, float, float, float]) -> str:
+    return ",".join(f"{value:.7f}" for value in tile)
+
+
+def key_to_tile(key: str) -> tuple[float, float, float, float]:
+    return tuple(float(value) for value in key.split(","))
+
+
+class CrawlProgress():
+    _LATEST_RUN_QUERY_TEMPLATE = """
+        select id, status, started_at from crawl_runs
+        where max_price=%s and radius=%s
+        order by id desc limit 1
+        """
+    _CREATE_RUN_QUERY_TEMPLATE = """
+        insert into crawl_runs (max_price, radius) values (%s, %s) returning id
+        """
+    # tiles finished by a recent run are taken over with their listings instead of crawled again
+    _COPY_FRESH_TILES_QUERY_TEMPLATE = """
+        with fresh as (
+            select distinct on (cp.tile) cp.run_id, cp.tile, cp.status, cp.next_index, cp.pages, cp.started_at, cp.finished_at
+            from crawl_progress as cp join crawl_runs as r on r.id=cp.run_id
+            where cp.tile = any(%(tiles)s) and cp.status = 'COMPLETE' and cp.finished_at > %(fresh_after)s
+            and r.max_price = %(max_price)s and r.radius = %(radius)s and r.id != %(run_id)s
+            order by cp.tile, cp.finished_at desc
+        ), copied as (
+            insert into crawl_progress (run_id, tile, status, next_index, pages, started_at, finished_at)
+            select %(run_id)s, tile, status, next_index, pages, started_at, finished_at from fresh
+        )
+        insert into crawl_seen_listings (run_id, property_id, tile)
+        select %(run_id)s, s.property_id, s.tile
+        from fresh join crawl_seen_listings as s on s.run_id=fresh.run_id and s.tile=fresh.tile
+        """
+    _CREATE_TILES_QUERY_TEMPLATE = """
+        insert into crawl_progress (run_id, tile)
+        select %s, unnest(%s::text[])
+        on conflict do nothing
+        """
+    _UNFINISHED_TILES_QUERY_TEMPLATE = """
+        select tile, next_index from crawl_progress
+        where run_id=%s and status not in ('COMPLETE', 'SPLIT')
+        """
+    _CLOSE_RUN_QUERY_TEMPLATE = "update crawl_runs set status='FAILED', finished_at=coalesce(finished_at, now()) where id=%s and status='RUNNING'"
+    _RESUME_RUN_QUERY_TEMPLATE = "update crawl_runs set status='RUNNING', finished_at=null where id=%s"
+    _RESET_FAILED_TILES_QUERY_TEMPLATE = "update crawl_progress set status='RUNNING' where run_id=%s and status='FAILED'"
+    # next_index only moves forward as writers of the same tile can commit out of order
+    _CHECKPOINT_QUERY_TEMPLATE = """
+        update crawl_progress set
+        status = case when status = 'FAILED' then status else %s::crawl_status end,
+        next_index = greatest(next_index, %s),
+        pages = pages + %s,
+        started_at = coalesce(started_at, now()),
+        finished_at = case when %s then now() end
+        where run_id=%s and tile=%s
+        """
+    # appended instead of kept in an array on crawl_progress, which every checkpoint would rewrite whole
+    _SEEN_LISTINGS_QUERY_TEMPLATE = """
+        insert into crawl_seen_listings (run_id, property_id, tile)
+        select %s, unnest(%s::bigint[]), %s
+        on conflict do nothing
+        """
+    _SET_TILE_STATUS_QUERY_TEMPLATE = """
+        update crawl_progress set status=%s, started_at=coalesce(started_at, now()), finished_at=now()
+        where run_id=%s and tile=%s
+        """
+    _FINISH_RUN_QUERY_TEMPLATE = """
+        update crawl_runs set
+        status = case when exists (select from crawl_progress where run_id=%(run_id)s and status not in ('COMPLETE', 'SPLIT')) then 'FAILED'::crawl_status else 'COMPLETE' end,
+        finished_at = now(),
+        pages = pages + %(pages)s,
+        listings = listings + %(listings)s,
+        rows_written = rows_written + %(rows_written)s
+        where id=%(run_id)s
+        returning status
+        """
+    _MARK_HISTORIC_QUERY_TEMPLATE = """
+        update properties as p set historic = true
+        where not p.historic
+        and not exists (select from crawl_seen_listings as s where s.run_id=%s and s.property_id=p.id)
+        """
+
+    def __init__(self, db_pool, run_id: int):
+        self.db_pool = db_pool
+        self.run_id = run_id
+        # pages handed to the writers but not committed yet, per tile
+        self._pending: dict[str, set[int]] = {}
+        # next index to fetch and whether the last page was fetched, per tile
+        self._fetched: dict[str, tuple[int, bool]] = {}
+
+    @staticmethod
+    async def start(db_pool, max_price: int, radius: int, tiles: list[tuple[float, float, float, float]], fresh_for: timedelta = timedelta(minutes=float(getenv("PROPERTY_CRAWL_FRESH_MINUTES", "30"))), resume_for: timedelta = _RESUME_FOR) -> tuple["CrawlProgress", list[tuple[tuple[float, float, float, float], int]]]:
+        async with db_pool.connection() as connection:
+            latest_run = await db_fetch_one(connection, CrawlProgress._LATEST_RUN_QUERY_TEMPLATE, [max_price, radius])
+            if latest_run != None and _is_resumable(latest_run[1], latest_run[2], resume_for):
+                run_id = latest_run[0]
+                await db_execute(connection, CrawlProgress._RESUME_RUN_QUERY_TEMPLATE, [run_id])
+                await db_execute(connection, CrawlProgress._RESET_FAILED_TILES_QUERY_TEMPLATE, [run_id])
+                print(f"Resuming crawl run {run_id}")
+            else:
+                if latest_run != None and latest_run[1] == CrawlStatus.RUNNING:
+                    await db_execute(connection, CrawlProgress._CLOSE_RUN_QUERY_TEMPLATE, [latest_run[0]])
+                    print(f"Closed crawl run {latest_run[0]} started at {latest_run[2]}")
+                run_id = (await db_fetch_one(connection, CrawlProgress._CREATE_RUN_QUERY_TEMPLATE, [max_price, radius]))[0]
+                keys = [tile_to_key(tile) for tile in tiles]
+                await db_execute(connection, CrawlProgress._COPY_FRESH_TILES_QUERY_TEMPLATE, {
+                    "run_id": run_id, "tiles": keys, "fresh_after": datetime.now() - fresh_for, "max_price": max_price, "radius": radius})
+                await db_execute(connection, CrawlProgress._CREATE_TILES_QUERY_TEMPLATE, [run_id, keys])
+                print(f"Started crawl run {run_id}")
+            unfinished = await db_fetch_all(connection, CrawlProgress._UNFINISHED_TILES_QUERY_TEMPLATE, [run_id])
+        return CrawlProgress(db_pool, run_id), [(key_to_tile(row[0]), row[1]) for row in unfinished]
+
+    def fetched(self, page: CrawledPage) -> None:
+        self._pending.setdefault(page.tile, set()).add(page.index)
+        self._fetched[page.tile] = (page.next_index, page.last)
+
+    async def checkpoint(self, connection, pages: list[CrawledPage]) -> None:
+        # runs in the transaction that writes the listings of these pages
+        by_tile: dict[str, list[CrawledPage]] = {}
+        for page in pages:
+            by_tile.setdefault(page.tile, []).append(page)
+        args = []
+        seen_args = []
+        for tile, tile_pages in sorted(by_tile.items()):
+            remaining = self._pending[tile] - \
+                {page.index for page in tile_pages}
+            next_index, last = self._fetched[tile]
+            complete = last and not remaining
+            args.append([
+                CrawlStatus.COMPLETE if complete else CrawlStatus.RUNNING,
+                min(remaining) if remaining else next_index,
+                len(tile_pages),
+                complete,
+                self.run_id,
+                tile
+            ])
+            seen_args.append([self.run_id, sorted({id for page in tile_pages for id in page.listing_ids}), tile])
+        await db_execute_many(connection, CrawlProgress._SEEN_LISTINGS_QUERY_TEMPLATE, seen_args)
+        await db_execute_many(connection, CrawlProgress._CHECKPOINT_QUERY_TEMPLATE, args)
+
+    def committed(self, pages: list[CrawledPage]) -> None:
+        for page in pages:
+            self._pending[page.tile].discard(page.index)
+
+    async def split(self, tile: str, children: list[str]) -> None:
+        async with self.db_pool.connection() as connection:
+            await db_execute(connection, CrawlProgress._CREATE_TILES_QUERY_TEMPLATE, [self.run_id, children])
+            await db_execute(connection, CrawlProgress._SET_TILE_STATUS_QUERY_TEMPLATE, [CrawlStatus.SPLIT, self.run_id, tile])
+
+    async def failed(self, tile: str) -> None:
+        async with self.db_pool.connection() as connection:
+            await db_execute(connection, CrawlProgress._SET_TILE_STATUS_QUERY_TEMPLATE, [CrawlStatus.FAILED, self.run_id, tile])
+
+    async def finish(self, pages: int, listings: int, rows_written: int) -> CrawlStatus:
+        async with self.db_pool.connection() as connection:
+            status = CrawlStatus((await db_fetch_one(connection, CrawlProgress._FINISH_RUN_QUERY_TEMPLATE, {
+                "run_id": self.run_id, "pages": pages, "listings": listings, "rows_written": rows_written}))[0])
+            # an incomplete sweep cannot tell a delisted property from one that was not fetched
+            if status == CrawlStatus.COMPLETE:
+                await db_execute(connection, CrawlProgress._MARK_HISTORIC_QUERY_TEMPLATE, [self.run_id])
+        return status
+
+
+# the property fetcher listens on this channel and starts a crawl unless one is running
+CRAWL_CHANNEL = "property_crawl"
+_CRAWL_RUNS_QUERY_TEMPLATE = """
+    select r.id, r.started_at, r.finished_at, r.status, r.max_price, r.radius, r.pages, r.listings, r.rows_written,
+    coalesce(jsonb_object_agg(t.status, t.count) filter (where t.status is not null), '{}')
+    from crawl_runs as r
+    left join (select run_id, status, count(*) from crawl_progress group by run_id, status) as t
+    on t.run_id=r.id
+    where %(run_id)s::integer is null or r.id=%(run_id)s
+    group by r.id
+    order by r.id desc
+    limit %(limit)s
+    """
+
+
+async def get_crawl_runs(connection, limit: int = 20, run_id: int | None = None) -> list[CrawlRun]:
+    rows = await db_fetch_all(connection, _CRAWL_RUNS_QUERY_TEMPLATE, {"run_id": run_id, "limit": limit})
+    return [CrawlRun(id=row[0], started_at=row[1], finished_at=row[2], status=row[3], max_price=row[4], radius=row[5],
+                     pages=row[6], listings=row[7], rows_written=row[8], tiles=row[9]) for row in rows]
+
+
+async def has_unfinished_crawl_run(connection, resume_for: timedelta = _RESUME_FOR) -> bool:
+    latest_run = await db_fetch_one(connection, "select status, started_at from crawl_runs order by id desc limit 1")
+    return latest_run != None and _is_resumable(latest_run[0], latest_run[1], resume_for)
+
+
+async def trigger_crawl(connection) -> None:
+    await db_execute(connection, "select pg_notify(%s, '')", [CRAWL_CHANNEL])
@@ -0,0 +1,62 @@
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+from typing import Any
+from os import getenv
+
+
+def get_conn_str():
+    return f"""
+    dbname={getenv('POSTGRES_DB')}
+    user={getenv('POSTGRES_USER')}
+    password={getenv('POSTGRES_PASSWORD')}
+    host={getenv('POSTGRES_HOST')}
+    """
+
+
+def get_db_connection_pool() -> AsyncConnectionPool:
+    min_size = int(getenv("DB_POOL_MIN_SIZE", "4"))
+    # statements running longer than this are cancelled by the server, 0 disables the timeout
+    statement_timeout = int(getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+    return AsyncConnectionPool(
+        conninfo=get_conn_str(), open=False,
+        min_size=min_size,
+        max_size=max(min_size, int(getenv("DB_POOL_MAX_SIZE", "10"))),
+        timeout=float(getenv("DB_POOL_TIMEOUT_SECONDS", "30")),
+        max_lifetime=float(getenv("DB_POOL_MAX_LIFETIME_SECONDS", "3600")),
+        max_idle=float(getenv("DB_POOL_MAX_IDLE_SECONDS", "600")),
+        kwargs={
+            "options": f"-c statement_timeout={statement_timeout}",
+            "prepare_threshold": int(getenv("DB_PREPARE_THRESHOLD", "5"))
+        }
+    )
+
+
+async def db_execute(connection: AsyncConnection, sql: str, args: list[Any] | None = None, prepare: bool | None = None) -> None:
+    async with connection.cursor() as cursor:
+        await cursor.execute(sql, args, prepare=prepare)
+
+
+async def db_fetch_one(connection: AsyncConnection, sql: str, args: list[Any] | None = None, prepare: bool | None = None) -> tuple[Any, ...] | None:
+    async with connection.cursor() as cursor:
+        await cursor.execute(sql, args, prepare=prepare)
+        return await cursor.fetchone()
+
+
+async def db_fetch_all(connection: AsyncConnection, sql: str, args: list[Any] | None = None, prepare: bool | None = None) -> list[tuple[Any, ...]]:
+    async with connection.cursor() as cursor:
+        await cursor.execute(sql, args, prepare=prepare)
+        return await cursor.fetchall()
+
+
+async def db_execute_many(connection: AsyncConnection, sql: str, args: list[Any] | None = None) -> None:
+    async with connection.cursor() as cursor:
+        await cursor.executemany(sql, args)
+
+
+async def db_execute_many_fetch(connection: AsyncConnection, sql: str, args: list[Any] | None = None) -> list[tuple[Any, ...]]:
+    results = []
+    async with connection.cursor() as cursor:
+        await cursor.executemany(sql, args, returning=True)
+        async for _ in cursor.results():
+            results.append(await cursor.fetchone())
+    return results
@@ -0,0 +1,348 @@
+from enum import Enum
+from datetime import datetime, timedelta
+from statistics import mean
+from typing import Optional
+from pydantic import BaseModel
+from os import getenv
+from .db import db_execute_many
+from .upstream import UpstreamClient
+import json
+import re
+
+JOURNEY_PLANNER_ENDPOINT = getenv("JOURNEY_PLANNER_ENDPOINT",
+                                  "https://jpservices.nationalrail.co.uk/journey-planner")
+JOURNEY_PLANNER_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Content-Type": "application/json"
+}
+_DATE_FORMAT = "%Y-%m-%d"
+
+
+class JourneyDirection(str, Enum):
+    OUTBOUND = "OUTBOUND"
+    RETURN = "RETURN"
+
+
+class StartType(str, Enum):
+    DEPART = "DEPART"
+    ARRIVE = "ARRIVE"
+    NONE = "NONE"
+
+
+class DayOfWeek(Enum):
+    SUN = 0
+    MON = 1
+    TUE = 2
+    WED = 3
+    THU = 4
+    FRI = 5
+    SAT = 6
+
+
+class TrainjourneyOptions(BaseModel):
+    start_time: str
+    start_type: StartType
+    return_time: str | None
+    return_type: StartType | None
+    day_of_week: DayOfWeek
+    rail_card: str
+
+    def is_return_journey(self):
+        return self.return_time != None
+
+
+class TrainJourneySearchRequest(TrainjourneyOptions):
+    origin: str
+    destination: str
+
+
+class JourneyTimeDetails(BaseModel):
+    fastest_time: int
+    average_time: int
+    slowest_time: int
+    least_changes: int
+    most_changes: int
+    shortest_wait: int | None = None
+    average_wait: int | None = None
+    longest_wait: int | None = None
+
+
+class Fare(BaseModel):
+    price: int
+    type: str
+    direction: str
+
+    def __lt__(self, other):
+        return self.price < other.price
+
+    def __gt__(self, other):
+        return self.price > other.price
+
+
+class JourneyFareDetails(BaseModel):
+    cheapest_return: Fare | None
+    cheapest_single: Optional[list[Fare]] = None
+
+
+class JourneyDetails(BaseModel):
+    journey_time_details: JourneyTimeDetails
+
+
+class JourneySummary(BaseModel):
+    outbound_details: JourneyDetails
+    return_details: Optional[JourneyDetails] = None
+    fare_details: JourneyFareDetails
+
+
+class TrainJourneySearchResponse(BaseModel):
+    checked_at: datetime
+    data: dict
+
+
+_TIME_DETAILS_FIELDS = list(JourneyTimeDetails.model_fields)
+SUMMARY_COLUMNS = [f"outbound_{field}" for field in _TIME_DETAILS_FIELDS] + \
+    [f"return_{field}" for field in _TIME_DETAILS_FIELDS] + [
+    "cheapest_return_price", "cheapest_return_type",
+    "cheapest_outward_single_price", "cheapest_outward_single_type",
+    "cheapest_inward_single_price", "cheapest_inward_single_type"
+]
+_CACHE_JOURNEY_QUERY_TEMPLATE = f"""
+            insert into journeys (origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card, data, {", ".join(SUMMARY_COLUMNS)}, summarised_at)
+            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, {", ".join(["%s"] * len(SUMMARY_COLUMNS))}, now())
+            on conflict (origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card)
+            do update set checked_at=now(), data=excluded.data, {", ".join([f"{column}=excluded.{column}" for column in SUMMARY_COLUMNS])}, summarised_at=now()
+            """
+_STORE_RESPONSES = getenv("JOURNEY_CACHE_STORE_RESPONSES", "true") == "true"
+
+
+def get_journey_key(search_request: TrainJourneySearchRequest) -> tuple:
+    # matches the journeys primary key, one way journeys are stored with an empty return
+    return (
+        search_request.origin,
+        search_request.destination,
+        search_request.start_time,
+        search_request.start_type,
+        (search_request.return_time if search_request.return_time !=
+         None else "00:00:00"),
+        (search_request.return_type if search_request.return_time !=
+         None else StartType.NONE),
+        search_request.day_of_week,
+        search_request.rail_card
+    )
+
+
+def response_to_summary(search_response: TrainJourneySearchResponse) -> JourneySummary | None:
+    outbound_time_summary = _get_journey_time_details(
+        search_response.data, JourneyDirection.OUTBOUND)
+    if outbound_time_summary == None:
+        return None
+    return_time_summary = _get_journey_time_details(
+        search_response.data, JourneyDirection.RETURN)
+    fare_details = _get_journey_fare_details(search_response.data)
+    return JourneySummary(
+        outbound_details=JourneyDetails(
+            journey_time_details=outbound_time_summary),
+        return_details=None if return_time_summary == None else JourneyDetails(
+            journey_time_details=return_time_summary),
+        fare_details=fare_details)
+
+
+def cached_columns_to_summary(columns: tuple) -> JourneySummary | None:
+    # columns are checked_at, the raw response if not yet summarised, then SUMMARY_COLUMNS
+    if columns[1] != None:
+        return response_to_summary(TrainJourneySearchResponse(checked_at=columns[0], data=columns[1]))
+    summary_columns = columns[2:]
+    if summary_columns[0] == None:
+        return None
+    fields_count = len(_TIME_DETAILS_FIELDS)
+    return_details = None
+    if summary_columns[fields_count] != None:
+        return_details = JourneyDetails(journey_time_details=JourneyTimeDetails(
+            **dict(zip(_TIME_DETAILS_FIELDS, summary_columns[fields_count:fields_count*2]))))
+    fares = summary_columns[fields_count*2:]
+    cheapest_return = None
+    if fares[0] != None:
+        cheapest_return = Fare(
+            price=fares[0], type=fares[1], direction="RETURN")
+    cheapest_single = None
+    if fares[2] != None:
+        cheapest_single = [
+            Fare(price=fares[2], type=fares[3], direction="OUTWARD")]
+        if fares[4] != None:
+            cheapest_single.append(
+                Fare(price=fares[4], type=fares[5], direction="INWARD"))
+    return JourneySummary(
+        outbound_details=JourneyDetails(journey_time_details=JourneyTimeDetails(
+            **dict(zip(_TIME_DETAILS_FIELDS, summary_columns[:fields_count])))),
+        return_details=return_details,
+        fare_details=JourneyFareDetails(cheapest_return=cheapest_return, cheapest_single=cheapest_single))
+
+
+def summary_to_columns(summary: JourneySummary | None) -> list:
+    columns = [None] * len(SUMMARY_COLUMNS)
+    if summary == None:
+        return columns
+    fields_count = len(_TIME_DETAILS_FIELDS)
+    outbound_details = summary.outbound_details.journey_time_details
+    columns[:fields_count] = [getattr(outbound_details, field)
+                              for field in _TIME_DETAILS_FIELDS]
+    if summary.return_details != None:
+        return_details = summary.return_details.journey_time_details
+        columns[fields_count:fields_count*2] = [getattr(return_details, field)
+                                                for field in _TIME_DETAILS_FIELDS]
+    fares = summary.fare_details
+    if fares.cheapest_return != None:
+        columns[fields_count*2:fields_count*2+2] = [
+            fares.cheapest_return.price, fares.cheapest_return.type]
+    if fares.cheapest_single != None:
+        for i in range(len(fares.cheapest_single)):
+            columns[fields_count*2+2+i*2:fields_count*2+4+i*2] = [
+                fares.cheapest_single[i].price, fares.cheapest_single[i].type]
+    return columns
+
+
+def _get_journey_time_details(data: dict, direction: JourneyDirection) -> JourneyTimeDetails | None:
+    durations = []
+    times = []
+    min_changes = None
+    max_changes = None
+    direction_field = "outwardJourneys" if direction == JourneyDirection.OUTBOUND else "inwardJourneys"
+    if direction_field not in data:
+        return None
+    for journey in data[direction_field]:
+        duration = 0
+        for durationPart in journey["duration"].split(" "):
+            durationNumber = int(re.match(r'\d+', durationPart)[0])
+            if durationPart.endswith("h"):
+                duration += durationNumber * 60
+            elif durationPart.endswith("m"):
+                duration += durationNumber
+        durations.append(duration)
+
+        times.append(datetime.strptime(
+            journey["timetable"]["scheduled"]["departure"], "%Y-%m-%dT%H:%M:%SZ"))
+
+        changes = len(journey["legs"])
+        if min_changes == None:
+            min_changes = changes
+            max_changes = changes
+        else:
+            min_changes = min(min_changes, changes)
+            max_changes = max(max_changes, changes)
+
+    if len(times) > 1:
+        wait_times = []
+        for i in range(0, len(times)-1, 2):
+            wait_times.append(
+                int((times[i+1] - times[i]).total_seconds() / 60))
+        return JourneyTimeDetails(
+            fastest_time=min(durations),
+            average_time=int(mean(durations)),
+            slowest_time=max(durations),
+            least_changes=min_changes,
+            most_changes=max_changes,
+            shortest_wait=min(wait_times),
+            average_wait=int(mean(wait_times)),
+            longest_wait=max(wait_times))
+    elif len(times) == 1:
+        return JourneyTimeDetails(
+            fastest_time=min(durations),
+            average_time=int(mean(durations)),
+            slowest_time=max(durations),
+            least_changes=min_changes,
+            most_changes=max_changes)
+    else:
+        return None
+
+
+def _get_journey_fare_details(data: dict) -> JourneyFareDetails:
+    return_fares = []
+    outbound_single_fares = []
+    inbound_single_fares = []
+    journeys = []
+    if "outwardJourneys" in data:
+        journeys += data["outwardJourneys"]
+    if "inwardJourneys" in data:
+        journeys += data["inwardJourneys"]
+    for journey in journeys:
+        for fare in journey["fares"]:
+            fare_details = Fare(
+                price=fare["totalPrice"], type=fare["typeDescription"], direction=fare["direction"])
+            if fare_details.direction == "RETURN":
+                return_fares.append(fare_details)
+            elif fare_details.direction == "OUTWARD":
+                outbound_single_fares.append(fare_details)
+            elif fare_details.direction == "INWARD":
+                inbound_single_fares.append(fare_details)
+
+    cheapest_return_fare = None
+    if len(return_fares) != 0:
+        return_fares.sort()
+        cheapest_return_fare = return_fares[0]
+
+    cheapest_single_fares = None
+    if len(outbound_single_fares) != 0:
+        outbound_single_fares.sort()
+        cheapest_single_fares = [outbound_single_fares[0]]
+        if len(inbound_single_fares) != 0:
+            inbound_single_fares.sort()
+            cheapest_single_fares.append(inbound_single_fares[0])
+
+    return JourneyFareDetails(cheapest_return=cheapest_return_fare, cheapest_single=cheapest_single_fares)
+
+
+def get_journey_api_request_body(search_request: TrainJourneySearchRequest) -> dict:
+    today = datetime.today()
+    current_week_day = today.weekday() + 1 if today.weekday() < 6 else 0
+    if current_week_day < search_request.day_of_week.value:
+        search_date = (today + timedelta(days=search_request.day_of_week.value -
+                                         current_week_day)).strftime(_DATE_FORMAT)
+    else:
+        search_date = (today + timedelta(days=7 - current_week_day +
+                                         search_request.day_of_week.value)).strftime(_DATE_FORMAT)
+    outward_time = f"{search_date}T{search_request.start_time}Z"
+    if search_request.return_time != None:
+        inward_time = f"{search_date}T{search_request.return_time}Z"
+
+    api_request_body = {
+        # Assume that numerical destinations are groups rather than stations
+        # e.g. 182 == Any London station
+        # TODO: is there a better way to detect is a station is a group?
+        "origin": {"crs": search_request.origin, "group": search_request.origin.isdigit()},
+        "destination": {"crs": search_request.destination, "group": search_request.destination.isdigit()},
+        "outwardTime": {"travelTime": outward_time, "type": search_request.start_type.name},
+        "fareRequestDetails": {
+            "passengers": {"adult": 1, "child": 0},
+            "fareClass": "ANY",
+            "railcards": [] if search_request.rail_card == None else [{"code": search_request.rail_card, "count": 1}]
+        },
+        "directTrains": False,
+        "reducedTransferTime": False,
+        "onlySearchForSleeper": False,
+        "overtakenTrains": True,
+        "useAlternativeServices": False,
+        "increasedInterchange": "ZERO"
+    }
+    if search_request.return_time != None:
+        api_request_body["inwardTime"] = {
+            "travelTime": inward_time, "type": search_request.return_type.name}
+
+    return api_request_body
+
+
+async def fetch_journey(journey_planner: UpstreamClient, search_request: TrainJourneySearchRequest) -> TrainJourneySearchResponse | None:
+    data = await journey_planner.post_json(JOURNEY_PLANNER_ENDPOINT, get_journey_api_request_body(search_request), headers=JOURNEY_PLANNER_HEADERS)
+    if data == None:
+        return None
+    return TrainJourneySearchResponse(checked_at=datetime.now(), data=data)
+
+
+async def store_journeys(connection, journeys: list[tuple[TrainJourneySearchRequest, TrainJourneySearchResponse, JourneySummary | None]]) -> None:
+    args = []
+    for journey in journeys:
+        args.append([
+            *get_journey_key(journey[0]),
+            json.dumps(journey[1].data) if _STORE_RESPONSES else None,
+            *summary_to_columns(journey[2])
+        ])
+    await db_execute_many(connection, _CACHE_JOURNEY_QUERY_TEMPLATE, args)
@@ -0,0 +1,409 @@
+from .db import db_execute, db_execute_many, db_fetch_all
+from .upstream import UpstreamClient, get_listing_client
+from .crawl_runs import CrawlProgress, CrawledPage, tile_to_key
+from .property_stations import refresh_property_stations
+from os import getenv
+from pydantic import BaseModel, Field, computed_field
+import asyncio
+from hashlib import blake2b
+import time
+import math
+import polyline
+from statistics import mean
+
+_BASE_URL = getenv("PROPERTY_LISTING_ENDPOINT",
+                   "https://www.rightmove.co.uk/api/property-search/listing/search")
+_PARAMS = {
+    "channel": "RENT",
+    "transactionType": "LETTING",
+    "dontShow": "houseShare,retirement,student"
+}
+_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Accept": "application/json",
+}
+
+_POISON_PILL = "POISON_PILL"
+_QUEUE_SIZE = 1000
+_BATCH_SIZE = 500
+_METERS_PER_DEGREE = 111320
+_TILE_SIZE = float(getenv("PROPERTY_TILE_SIZE_METERS", "4000"))
+_MIN_TILE_SIZE = float(getenv("PROPERTY_MIN_TILE_SIZE_METERS", "250"))
+_MAX_RESULTS = int(getenv("PROPERTY_SEARCH_MAX_RESULTS", "1000"))
+_LISTING_HASHES_QUERY_TEMPLATE = "select id, listing_hash from properties where not historic and listing_hash is not null"
+
+
+class CrawlStats(BaseModel):
+    tiles: int = 0
+    split_tiles: int = 0
+    failed_tiles: int = 0
+    pages: int = 0
+    listings: int = 0
+    duplicates: int = 0
+    started_at: float = Field(default_factory=time.time)
+
+    @computed_field
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / max(time.time() - self.started_at, 1e-9)
+
+
+def plan_search_tiles(stations: list[tuple[float, float]], radius: float, tile_size: float = _TILE_SIZE) -> list[tuple[float, float, float, float]]:
+    # covers every station circle with a fixed grid so that overlapping circles share tiles
+    if not stations:
+        return []
+    lat_step = tile_size / _METERS_PER_DEGREE
+    lon_step = tile_size / (_METERS_PER_DEGREE *
+                            math.cos(math.radians(mean(station[1] for station in stations))))
+    tiles = set()
+    for longitude, latitude in stations:
+        lat_radius = radius / _METERS_PER_DEGREE
+        lon_radius = radius / (_METERS_PER_DEGREE *
+                               math.cos(math.radians(latitude)))
+        for i in range(math.floor((longitude - lon_radius) / lon_step), math.floor((longitude + lon_radius) / lon_step) + 1):
+            for j in range(math.floor((latitude - lat_radius) / lat_step), math.floor((latitude + lat_radius) / lat_step) + 1):
+                tile = (i * lon_step, j * lat_step,
+                        (i + 1) * lon_step, (j + 1) * lat_step)
+                if _distance_to_tile((longitude, latitude), tile) <= radius:
+                    tiles.add((i, j))
+    return [(i * lon_step, j * lat_step, (i + 1) * lon_step, (j + 1) * lat_step) for i, j in sorted(tiles)]
+
+
+def _distance_to_tile(point: tuple[float, float], tile: tuple[float, float, float, float]) -> float:
+    nearest_longitude = min(max(point[0], tile[0]), tile[2])
+    nearest_latitude = min(max(point[1], tile[1]), tile[3])
+    dx = (nearest_longitude - point[0]) * _METERS_PER_DEGREE * \
+        math.cos(math.radians(point[1]))
+    dy = (nearest_latitude - point[1]) * _METERS_PER_DEGREE
+    return math.hypot(dx, dy)
+
+
+def _split_tile(tile: tuple[float, float, float, float]) -> list[tuple[float, float, float, float]]:
+    mid_longitude = (tile[0] + tile[2]) / 2
+    mid_latitude = (tile[1] + tile[3]) / 2
+    return [
+        (tile[0], tile[1], mid_longitude, mid_latitude),
+        (mid_longitude, tile[1], tile[2], mid_latitude),
+        (tile[0], mid_latitude, mid_longitude, tile[3]),
+        (mid_longitude, mid_latitude, tile[2], tile[3])
+    ]
+
+
+def _tile_size(tile: tuple[float, float, float, float]) -> float:
+    return (tile[3] - tile[1]) * _METERS_PER_DEGREE
+
+
+def _create_tile_polyline(tile: tuple[float, float, float, float]) -> str:
+    return polyline.encode([
+        (tile[1], tile[0]),
+        (tile[1], tile[2]),
+        (tile[3], tile[2]),
+        (tile[3], tile[0]),
+        (tile[1], tile[0])
+    ])
+
+
+def _get_result_count(data: dict) -> int:
+    # returned as a display string, e.g. "1,234"
+    try:
+        return int(str(data.get("resultCount", "0")).replace(",", ""))
+    except ValueError:
+        return 0
+
+
+class ListingCrawler():
+    def __init__(self, listing_client: UpstreamClient, max_price: int, output: asyncio.Queue, stats: CrawlStats, base_url: str = _BASE_URL, progress: CrawlProgress | None = None):
+        self.listing_client = listing_client
+        self.max_price = max_price
+        self.output = output
+        self.stats = stats
+        self.base_url = base_url
+        self.progress = progress
+        self.seen_ids = set()
+
+    async def crawl(self, tiles: list[tuple[tuple[float, float, float, float], int]], concurrency: int) -> None:
+        # tiles with the index to start paging from, tiles over the result cap add their quarters to the same queue
+        tile_queue = asyncio.Queue()
+        for tile in tiles:
+            tile_queue.put_nowait(tile)
+        self.stats.tiles += len(tiles)
+        workers = [asyncio.create_task(self._crawl_worker(tile_queue))
+                   for _ in range(concurrency)]
+        try:
+            await tile_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _crawl_worker(self, tile_queue: asyncio.Queue) -> None:
+        while True:
+            tile, index = await tile_queue.get()
+            try:
+                await self._fetch_for_tile(tile, index, tile_queue)
+            except Exception as error:
+                print(f"Failed to crawl tile {tile}: {error!r}")
+                await self._fail(tile)
+            finally:
+                tile_queue.task_done()
+
+    async def _fail(self, tile: tuple[float, float, float, float]) -> None:
+        self.stats.failed_tiles += 1
+        if self.progress != None:
+            await self.progress.failed(tile_to_key(tile))
+
+    async def _fetch_for_tile(self, tile: tuple[float, float, float, float], index: int, tile_queue: asyncio.Queue) -> None:
+        params = {
+            **_PARAMS,
+            "locationIdentifier": "USERDEFINEDAREA^{\"polylines\":\"" + _create_tile_polyline(tile) + "\"}",
+            "maxPrice": self.max_price
+        }
+        while True:
+            params["index"] = index
+            data = await self.listing_client.get_json(self.base_url, headers=_HEADERS, params=params)
+            if data == None:
+                print(f"Skipping tile {tile} at index {index}")
+                await self._fail(tile)
+                return
+            self.stats.pages += 1
+            if index == 0 and _get_result_count(data) > _MAX_RESULTS and _tile_size(tile) / 2 >= _MIN_TILE_SIZE:
+                # the listing api stops paging at its result cap, so search smaller tiles instead
+                children = _split_tile(tile)
+                if self.progress != None:
+                    await self.progress.split(tile_to_key(tile), [tile_to_key(child) for child in children])
+                self.stats.split_tiles += 1
+                self.stats.tiles += len(children)
+                for child in children:
+                    tile_queue.put_nowait((child, 0))
+                return
+            if "pagination" in data and "next" in data["pagination"]:
+                next = int(data["pagination"]["next"])
+            else:
+                next = index
+            listings = data.get("properties", [])
+            properties = [property for property in listings
+                          if property["id"] not in self.seen_ids]
+            self.stats.listings += len(listings)
+            self.stats.duplicates += len(listings) - len(properties)
+            self.seen_ids.update(property["id"] for property in properties)
+            page = CrawledPage(tile_to_key(tile), index, next, next == index or data.get("notFound", False),
+                               [property["id"] for property in listings], properties)
+            if self.progress != None:
+                self.progress.fetched(page)
+            # blocks while the writers are behind
+            await self.output.put(page)
+            if page.last:
+                return
+            index = next
+
+
+def _parse_properties(propertiesJson) -> list[tuple]:
+    properties = []
+    for property in propertiesJson:
+        price = property["price"]["amount"]
+        if property["price"]["frequency"] == "weekly":
+            price = price * 4
+        properties.append((
+            property["id"],
+            property["location"]["longitude"],
+            property["location"]["latitude"],
+            property["displayAddress"],
+            price,
+            property["bedrooms"],
+            property["bathrooms"]))
+    return [(*property, _get_listing_hash(property)) for property in properties]
+
+
+def _get_listing_hash(property: tuple) -> int:
+    # stable across processes unlike hash(), stored as a signed bigint
+    return int.from_bytes(blake2b(repr(property).encode(), digest_size=8).digest(), signed=True)
+
+
+class ExecuteManyPropertyWriter():
+    _UPSERT_QUERY_TEMPLATE = """
+    INSERT INTO properties (id, location, address, price, bedrooms, bathrooms, listing_hash) 
+    values (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s, %s, %s, %s, %s) 
+    ON CONFLICT(id) DO UPDATE SET 
+    location = EXCLUDED.location,
+    address = EXCLUDED.address,
+    price = EXCLUDED.price,
+    bedrooms = EXCLUDED.bedrooms,
+    bathrooms = EXCLUDED.bathrooms,
+    listing_hash = EXCLUDED.listing_hash,
+    historic = false
+    WHERE properties.historic or properties.listing_hash is distinct from EXCLUDED.listing_hash
+    """
+
+    async def write(self, connection, properties: list[tuple]) -> None:
+        # lock rows in id order so that concurrent writers cannot deadlock
+        await db_execute_many(connection, ExecuteManyPropertyWriter._UPSERT_QUERY_TEMPLATE, sorted(properties, key=lambda property: property[0]))
+
+
+class CopyPropertyWriter():
+    # one staging table per pooled connection, emptied by every commit
+    _CREATE_STAGING_QUERY_TEMPLATE = """
+    create temp table if not exists properties_staging (
+        id bigint,
+        longitude double precision,
+        latitude double precision,
+        address text,
+        price integer,
+        bedrooms smallint,
+        bathrooms smallint,
+        listing_hash bigint
+    ) on commit delete rows
+    """
+    _COPY_QUERY_TEMPLATE = "copy properties_staging (id, longitude, latitude, address, price, bedrooms, bathrooms, listing_hash) from stdin (format binary)"
+    _COPY_TYPES = ["int8", "float8", "float8", "text", "int4", "int2", "int2", "int8"]
+    # a listing can be returned by more than one search area and ON CONFLICT can only update a row once
+    _MERGE_QUERY_TEMPLATE = """
+    INSERT INTO properties (id, location, address, price, bedrooms, bathrooms, listing_hash)
+    select distinct on (id) id, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography, address, price, bedrooms, bathrooms, listing_hash
+    from properties_staging
+    order by id
+    ON CONFLICT(id) DO UPDATE SET 
+    location = EXCLUDED.location,
+    address = EXCLUDED.address,
+    price = EXCLUDED.price,
+    bedrooms = EXCLUDED.bedrooms,
+    bathrooms = EXCLUDED.bathrooms,
+    listing_hash = EXCLUDED.listing_hash,
+    historic = false
+    WHERE properties.historic or properties.listing_hash is distinct from EXCLUDED.listing_hash
+    """
+
+    async def write(self, connection, properties: list[tuple]) -> None:
+        await db_execute(connection, CopyPropertyWriter._CREATE_STAGING_QUERY_TEMPLATE)
+        async with connection.cursor() as cursor:
+            async with cursor.copy(CopyPropertyWriter._COPY_QUERY_TEMPLATE) as copy:
+                copy.set_types(CopyPropertyWriter._COPY_TYPES)
+                for property in properties:
+                    await copy.write_row(property)
+        await db_execute(connection, CopyPropertyWriter._MERGE_QUERY_TEMPLATE)
+
+
+_PROPERTY_WRITERS = {
+    "executemany": ExecuteManyPropertyWriter,
+    "copy": CopyPropertyWriter
+}
+
+
+def get_property_writer(name: str | None = None):
+    return _PROPERTY_WRITERS[name or getenv("PROPERTY_WRITER", "copy")]()
+
+
+class PropertyWriteStats(BaseModel):
+    rows: int = 0
+    unchanged: int = 0
+    batches: int = 0
+    write_time: float = 0
+    started_at: float = Field(default_factory=time.time)
+
+    def add(self, rows: int, write_time: float) -> None:
+        self.rows += rows
+        self.batches += 1
+        self.write_time += write_time
+
+    @computed_field
+    @property
+    def rows_per_write_second(self) -> float:
+        return self.rows / max(self.write_time, 1e-9)
+
+    @computed_field
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / max(time.time() - self.started_at, 1e-9)
+
+
+async def write_properties(connection, propertiesJson, writer=None, known_hashes: dict[int, int] | None = None) -> list[tuple]:
+    properties = _parse_properties(propertiesJson)
+    if known_hashes != None:
+        properties = [property for property in properties
+                      if known_hashes.get(property[0]) != property[-1]]
+    if properties:
+        await (writer or get_property_writer()).write(connection, properties)
+        await refresh_property_stations(connection, [property[0] for property in properties])
+    return properties
+
+
+def _remember_hashes(known_hashes: dict[int, int] | None, properties: list[tuple]) -> None:
+    if known_hashes != None:
+        known_hashes.update((property[0], property[-1])
+                            for property in properties)
+
+
+async def store_properties(connection, propertiesJson, writer=None, known_hashes: dict[int, int] | None = None) -> int:
+    properties = await write_properties(connection, propertiesJson, writer, known_hashes)
+    await connection.commit()
+    _remember_hashes(known_hashes, properties)
+    return len(properties)
+
+
+async def _load_listing_hashes(db_pool) -> dict[int, int]:
+    async with db_pool.connection() as connection:
+        return dict(await db_fetch_all(connection, _LISTING_HASHES_QUERY_TEMPLATE))
+
+
+async def _create_worker(queue: asyncio.Queue, db_pool, writer, stats: PropertyWriteStats, known_hashes: dict[int, int], progress: CrawlProgress) -> None:
+    running = True
+    while running:
+        pages = []
+        listings = []
+        while len(listings) < _BATCH_SIZE:
+            page = await queue.get()
+            queue.task_done()
+            if page == _POISON_PILL:
+                running = False
+                break
+            pages.append(page)
+            listings += page.properties
+        if not pages:
+            continue
+        write_start_time = time.time()
+        # the progress of the pages is committed with their listings
+        async with db_pool.connection() as connection:
+            properties = await write_properties(connection, listings, writer, known_hashes)
+            await progress.checkpoint(connection, pages)
+            await connection.commit()
+        progress.committed(pages)
+        _remember_hashes(known_hashes, properties)
+        stats.add(len(properties), time.time() - write_start_time)
+        stats.unchanged += len(listings) - len(properties)
+        print(
+            f"Total_processed={stats.rows}, unchanged={stats.unchanged}, queue_size={queue.qsize()}: Wrote {len(properties)}/{len(listings)} of batch in {time.time()-write_start_time} seconds")
+
+
+async def fetch_properties_by_stations(db_pool, max_price=2500, radius=3500, writer_name: str | None = None, writers: int = int(getenv("PROPERTY_WRITERS", "3")), concurrency: int | None = None) -> None:
+    print("Starting property search")
+    queue = asyncio.Queue(_QUEUE_SIZE)
+    writer = get_property_writer(writer_name)
+    stats = PropertyWriteStats()
+    crawl_stats = CrawlStats()
+    # only listings that are new or changed since the last sweep are written
+    known_hashes = await _load_listing_hashes(db_pool)
+    async with db_pool.connection() as connection:
+        stations = await db_fetch_all(connection, "select ST_X(location::geometry), ST_Y(location::geometry) from stations")
+    tiles = plan_search_tiles(stations, radius)
+    progress, unfinished_tiles = await CrawlProgress.start(db_pool, max_price, radius, tiles)
+    print(
+        f"Planned {len(tiles)} search tiles for {len(stations)} stations, {len(unfinished_tiles)} left to crawl in run {progress.run_id}")
+    listing_client = get_listing_client()
+    await listing_client.open()
+    try:
+        crawler = ListingCrawler(
+            listing_client, max_price, queue, crawl_stats, progress=progress)
+        async with asyncio.TaskGroup() as task_group:
+            for _ in range(writers):
+                task_group.create_task(
+                    _create_worker(queue, db_pool, writer, stats, known_hashes, progress))
+            await crawler.crawl(unfinished_tiles, concurrency or listing_client.max_concurrency)
+            for _ in range(writers):
+                await queue.put(_POISON_PILL)
+        await queue.join()
+    finally:
+        await listing_client.close()
+    print(
+        f"Searched tiles={crawl_stats.tiles}, split_tiles={crawl_stats.split_tiles}, failed_tiles={crawl_stats.failed_tiles}, pages={crawl_stats.pages}, pages_per_second={crawl_stats.pages_per_second:.1f}, listings={crawl_stats.listings}, duplicates={crawl_stats.duplicates}, retries={listing_client.retries}")
+    print(
+        f"Done! writer={type(writer).__name__}, writers={writers}, rows={stats.rows}, unchanged={stats.unchanged}, batches={stats.batches}, write_time={stats.write_time:.2f}s, rows_per_write_second={stats.rows_per_write_second:.0f}, rows_per_second={stats.rows_per_second:.0f}")
+    status = await progress.finish(crawl_stats.pages, crawl_stats.listings, stats.rows)
+    print(f"Crawl run {progress.run_id} finished with status {status.name}")
@@ -0,0 +1,31 @@
+from .db import db_execute
+from os import getenv
+
+# property_station only holds pairs up to this distance, searches cannot go further
+PROPERTY_STATION_MAX_DISTANCE = int(
+    getenv("PROPERTY_STATION_MAX_DISTANCE_METERS", "5000"))
+
+_DELETE_PROPERTY_STATIONS_QUERY_TEMPLATE = "delete from property_station where property_id = any(%s)"
+_INSERT_PROPERTY_STATIONS_QUERY_TEMPLATE = """
+    insert into property_station (property_id, station_id, distance_m)
+    select p.id, s.id, ST_Distance(p.location, s.location)
+    from properties as p join stations as s
+    on ST_DWithin(p.location, s.location, %(max_distance)s)
+    where %(property_ids)s::bigint[] is null or p.id = any(%(property_ids)s)
+    """
+
+
+async def refresh_property_stations(connection, property_ids: list[int]) -> None:
+    # runs in the transaction that wrote the properties, a moved listing gets new distances
+    if not property_ids:
+        return
+    await db_execute(connection, _DELETE_PROPERTY_STATIONS_QUERY_TEMPLATE, [property_ids])
+    await db_execute(connection, _INSERT_PROPERTY_STATIONS_QUERY_TEMPLATE, {
+        "max_distance": PROPERTY_STATION_MAX_DISTANCE, "property_ids": property_ids})
+
+
+async def rebuild_property_stations(connection) -> None:
+    # after stations change or PROPERTY_STATION_MAX_DISTANCE_METERS is raised
+    await db_execute(connection, "truncate property_station")
+    await db_execute(connection, _INSERT_PROPERTY_STATIONS_QUERY_TEMPLATE, {
+        "max_distance": PROPERTY_STATION_MAX_DISTANCE, "property_ids": None})
@@ -0,0 +1,156 @@
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+from typing import Any
+from os import getenv
+from urllib.parse import urlsplit
+import asyncio
+import random
+import time
+
+
+class TokenBucket():
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens +
+                                   (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class UpstreamClient():
+    _RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+            self,
+            max_concurrency: int = 8,
+            requests_per_second: float = 10,
+            burst: int = 10,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 10,
+            timeout: float = 30,
+            keepalive_timeout: float = 60,
+            retry_budget: float = 0.2):
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.retry_budget = retry_budget
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # one bucket per host so that a slow host does not use up the rate of another
+        self._buckets: dict[str, TokenBucket] = {}
+        self._session = None
+
+    async def open(self) -> None:
+        if self._session == None:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.max_concurrency, keepalive_timeout=self.keepalive_timeout),
+                timeout=ClientTimeout(total=self.timeout))
+
+    async def close(self) -> None:
+        if self._session != None:
+            await self._session.close()
+            self._session = None
+
+    async def get_json(self, url: str, headers: dict[str, str] | None = None, params: dict | None = None) -> Any | None:
+        return await self._request_json("GET", url, headers=headers, params=params)
+
+    async def post_json(self, url: str, body: dict, headers: dict[str, str] | None = None) -> Any | None:
+        return await self._request_json("POST", url, headers=headers, json=body)
+
+    async def _request_json(self, method: str, url: str, **kwargs) -> Any | None:
+        attempt = 0
+        while True:
+            retry_after = None
+            async with self._semaphore:
+                await self._get_bucket(url).acquire()
+                self.requests += 1
+                try:
+                    async with self._session.request(method, url, **kwargs) as response:
+                        if response.status not in UpstreamClient._RETRY_STATUSES:
+                            if response.status == 400:
+                                print(f"Bad request: {method} {url}")
+                                self.failures += 1
+                                return None
+                            if response.content_type != "application/json":
+                                print(
+                                    f"Non JSON response ({response.status}): {method} {url}")
+                                self.failures += 1
+                                return None
+                            return await response.json()
+                        print(f"Retryable response ({response.status}): {method} {url}")
+                        retry_after = response.headers.get("Retry-After")
+                except (ClientError, asyncio.TimeoutError) as error:
+                    print(f"Request failed ({error!r}): {method} {url}")
+            if attempt >= self.max_retries:
+                self.failures += 1
+                return None
+            if not self._can_retry():
+                print(f"Retry budget exhausted: {method} {url}")
+                self.failures += 1
+                return None
+            # sleep outside of the semaphore so other requests can use the slot
+            await asyncio.sleep(self._get_backoff(attempt, retry_after))
+            attempt += 1
+            self.retries += 1
+
+    def _get_bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket == None:
+            bucket = TokenBucket(self.requests_per_second, self.burst)
+            self._buckets[host] = bucket
+        return bucket
+
+    def _can_retry(self) -> bool:
+        # retries are limited to a share of all requests so that an overloaded upstream is not hit harder
+        return self.retries < self.max_concurrency + self.retry_budget * self.requests
+
+    def _get_backoff(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after != None and retry_after.isdigit():
+            return min(self.backoff_max, float(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def get_journey_planner_client() -> UpstreamClient:
+    return UpstreamClient(
+        max_concurrency=int(getenv("JOURNEY_PLANNER_MAX_CONCURRENCY", "8")),
+        requests_per_second=float(
+            getenv("JOURNEY_PLANNER_REQUESTS_PER_SECOND", "10")),
+        burst=int(getenv("JOURNEY_PLANNER_BURST", "10")),
+        max_retries=int(getenv("JOURNEY_PLANNER_MAX_RETRIES", "3")),
+        timeout=float(getenv("JOURNEY_PLANNER_TIMEOUT_SECONDS", "30"))
+    )
+
+
+def get_listing_client() -> UpstreamClient:
+    return UpstreamClient(
+        max_concurrency=int(getenv("PROPERTY_FETCH_MAX_CONCURRENCY", "8")),
+        requests_per_second=float(
+            getenv("PROPERTY_FETCH_REQUESTS_PER_SECOND", "5")),
+        burst=int(getenv("PROPERTY_FETCH_BURST", "5")),
+        max_retries=int(getenv("PROPERTY_FETCH_MAX_RETRIES", "4")),
+        timeout=float(getenv("PROPERTY_FETCH_TIMEOUT_SECONDS", "30")),
+        retry_budget=float(getenv("PROPERTY_FETCH_RETRY_BUDGET", "0.2"))
+    )
@@ -1,21 +1,79 @@
-import psycopg
-from journey import TrainJourneySearchRequest, TrainJourneySearchResponse, JourneyFinder, DayOfWeek, StartType
-from property import PropertySearchRequest, PropertySearchResponse, Property, Station, PropertyFinder
+from core.db import get_db_connection_pool, db_fetch_all
+from core.journey import TrainJourneySearchRequest, StartType, DayOfWeek, fetch_journey, response_to_summary, store_journeys
+from core.upstream import get_journey_planner_client, UpstreamClient
+import argparse
+import asyncio
+import time
+
+_STATIONS_QUERY_TEMPLATE = "select id from stations order by id"
+
+
+async def _fetch_with_request(journey_planner: UpstreamClient, search_request: TrainJourneySearchRequest):
+    return (search_request, await fetch_journey(journey_planner, search_request))
+
+
+async def _plan_batch(db_pool, journey_planner: UpstreamClient, search_requests: list[TrainJourneySearchRequest]) -> int:
+    to_store = []
+    for future in asyncio.as_completed([_fetch_with_request(journey_planner, search_request) for search_request in search_requests]):
+        # as_completed loses the request order so keep it with the response
+        search_request, response = await future
+        if response == None:
+            print(f"No journeys found from {search_request.origin}")
+            continue
+        to_store.append((search_request, response,
+                        response_to_summary(response)))
+    if to_store:
+        async with db_pool.connection() as connection:
+            await store_journeys(connection, to_store)
+    return len(to_store)
+
+
+async def main(args) -> None:
+    start_time = time.time()
+    db_pool = get_db_connection_pool()
+    journey_planner = get_journey_planner_client()
+    await db_pool.open()
+    await journey_planner.open()
+    try:
+        stations = args.stations
+        if not stations:
+            async with db_pool.connection() as connection:
+                stations = [row[0] for row in await db_fetch_all(connection, _STATIONS_QUERY_TEMPLATE)]
+        search_requests = [TrainJourneySearchRequest(
+            origin=station,
+            destination=args.destination,
+            start_time=args.start_time,
+            start_type=StartType[args.start_type],
+            return_time=None if args.one_way else args.return_time,
+            return_type=None if args.one_way else StartType[args.return_type],
+            day_of_week=DayOfWeek[args.day_of_week],
+            rail_card=args.rail_card
+        ) for station in stations]
+        print(f"Planning {len(search_requests)} journeys to {args.destination}")
+        # batches run concurrently, the client bounds how many requests reach the journey planner
+        stored = await asyncio.gather(*[_plan_batch(db_pool, journey_planner, search_requests[i:i+args.batch_size])
+                                        for i in range(0, len(search_requests), args.batch_size)])
+        print(
+            f"Stored {sum(stored)}/{len(search_requests)} journeys in {time.time()-start_time} seconds, requests={journey_planner.requests}, retries={journey_planner.retries}, failures={journey_planner.failures}")
+    finally:
+        await journey_planner.close()
+        await db_pool.close()
+
 
 if __name__ == "__main__":
-    print("start")
-    with psycopg.connect("dbname=db host=db user=admin password=admin") as connection:
-        print("connected")
-        property_finder = PropertyFinder(connection)
-        properties_by_station = property_finder.search(PropertySearchRequest(
-            1200, 2000, (-0.08520316157833625, 51.519510935879914)))
-        journey_finder = JourneyFinder(connection)
-        for station, properties in properties_by_station.results.items():
-            print(
-                f"{len(properties)} properties found by {station.name}. Checking travel time...")
-            journey_details = journey_finder.search(TrainJourneySearchRequest(
-                station.id, "182", "09:15:00", StartType.ARRIVE, "17:30:00", StartType.DEPART, DayOfWeek.TUE, "YNG"))
-            if journey_details != None:
-                print(journey_details.get_journey_summary())
-            else:
-                print("No journeys found!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", nargs="*",
+                        help="station ids to plan from, all stations when empty")
+    parser.add_argument("--destination", default="182")
+    parser.add_argument("--start-time", default="09:15:00")
+    parser.add_argument("--start-type", default="ARRIVE",
+                        choices=[StartType.DEPART.name, StartType.ARRIVE.name])
+    parser.add_argument("--return-time", default="17:30:00")
+    parser.add_argument("--return-type", default="DEPART",
+                        choices=[StartType.DEPART.name, StartType.ARRIVE.name])
+    parser.add_argument("--one-way", action="store_true")
+    parser.add_argument("--day-of-week", default="TUE",
+                        choices=[day.name for day in DayOfWeek])
+    parser.add_argument("--rail-card", default="YNG")
+    parser.add_argument("--batch-size", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -1,75 +1,70 @@
-import requests
-import json
-from time import sleep
-import psycopg
+from core.db import get_db_connection_pool, get_conn_str
+from core.properties import fetch_properties_by_stations
+from core.crawl_runs import CRAWL_CHANNEL, has_unfinished_crawl_run
+from core.property_stations import rebuild_property_stations
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from datetime import datetime
+from os import getenv
+from psycopg import AsyncConnection, sql
+import argparse
+import asyncio
 
-baseUrl = 'https://www.rightmove.co.uk/api/property-search/listing/search'
-params = {
-    'locationIdentifier': 'USERDEFINEDAREA^{"polylines":"mdluHuovH~~c@|xeA?x|_D?dmwO?djwC?bbqD_waApknAyow@t{Zynh@rcA}fpC}re@ooqDijp@_|rBkso@?wehJ?sjfD?w|fG|oqAezcBj}b@gvpBr{z@uxpCtzwBbjTzkiFh|i@px`@hdP"}',
-    'channel': 'RENT',
-    'sortType': '6',
-    'transactionType': 'LETTING',
-    'displayLocationIdentifier': 'undefined',
-    'dontShow': 'houseShare,retirement,student',
-    'maxPrice': '1400',
-    'minBedrooms': '1'
-}
-headers = {}
+_CRAWL_JOB_ID = "crawl"
 
 
-def fetchProperties(cursor):
-    index = 0
-    next = None
-    while (index != next):
-        if next != None:
-            index = next
-        params['index'] = index
-        r = requests.get(baseUrl, params=params, headers=headers)
-        response = json.loads(r.text)
-        if 'pagination' not in response:
-            print('No pagination')
-            print(response)
-        elif 'next' not in response['pagination']:
-            print('No next page')
-        else:
-            next = int(response['pagination']['next'])
-        storeProperties(cursor, response['properties'])
-        sleep(0.1)
+async def _listen_for_triggers(scheduler: AsyncIOScheduler) -> None:
+    # a dedicated connection, notifications are only delivered outside of a transaction
+    async with await AsyncConnection.connect(get_conn_str(), autocommit=True) as connection:
+        await connection.execute(sql.SQL("listen {}").format(sql.Identifier(CRAWL_CHANNEL)))
+        print(f"Listening for crawl triggers on {CRAWL_CHANNEL}")
+        async for _ in connection.notifies():
+            print("Crawl triggered")
+            # a crawl that is already running is not started twice
+            scheduler.modify_job(_CRAWL_JOB_ID, next_run_time=datetime.now())
 
 
-def storeProperties(cursor, propertiesJson):
-    if len(propertiesJson) == 0:
-        return
-    properties = []
-    for property in propertiesJson:
-        id = property['id']
-        longitude = property['location']['longitude']
-        latitude = property['location']['latitude']
-        location = "point({} {})".format(longitude, latitude)
-        address = property['displayAddress']
-        # TODO: handle non monthly prices
-        price = property['price']['amount']
-        bedrooms = property['bedrooms']
-        bathrooms = property['bathrooms']
-        properties.append([id, location, address, price, bedrooms, bathrooms])
-
-    cursor.executemany(
-        """INSERT INTO properties (id, location, address, price, bedrooms, bathrooms) 
-    values (%s, %s, %s, %s, %s, %s) 
-    ON CONFLICT(id) DO UPDATE SET 
-    location = EXCLUDED.location,
-    address = EXCLUDED.address,
-    price = EXCLUDED.price,
-    bedrooms = EXCLUDED.bedrooms,
-    bathrooms = EXCLUDED.bathrooms
-    """,
-        properties)
-    print("Stored {} properties".format(len(properties)))
+async def main(args) -> None:
+    db_pool = get_db_connection_pool()
+    await db_pool.open()
+    try:
+        if args.rebuild_property_stations:
+            async with db_pool.connection() as connection:
+                await rebuild_property_stations(connection)
+            print("Rebuilt property_station")
+            return
+        if args.once:
+            await fetch_properties_by_stations(db_pool, args.max_price, args.radius, args.writer, args.writers)
+            return
+        async with db_pool.connection() as connection:
+            resume_crawl = await has_unfinished_crawl_run(connection)
+        scheduler = AsyncIOScheduler()
+        # a late run is coalesced into one, an interrupted run is resumed straight away
+        scheduler.add_job(fetch_properties_by_stations, 'interval', minutes=args.interval, id=_CRAWL_JOB_ID,
+                          args=[db_pool, args.max_price, args.radius, args.writer, args.writers], coalesce=True, max_instances=1,
+                          misfire_grace_time=int(getenv("PROPERTY_CRAWL_MISFIRE_GRACE_SECONDS", "300")),
+                          **({"next_run_time": datetime.now()} if resume_crawl else {}))
+        scheduler.start()
+        try:
+            await _listen_for_triggers(scheduler)
+        finally:
+            scheduler.shutdown()
+    finally:
+        await db_pool.close()
 
 
 if __name__ == "__main__":
-    print('Started!')
-    with psycopg.connect("dbname=db host=db user=admin password=admin") as connection:
-        with connection.cursor() as cursor:
-            fetchProperties(cursor)
-            connection.commit()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-price", type=int, default=2500)
+    parser.add_argument("--radius", type=int, default=3500)
+    parser.add_argument("--writer", choices=["copy", "executemany"],
+                        default=getenv("PROPERTY_WRITER", "copy"))
+    parser.add_argument("--writers", type=int,
+                        default=int(getenv("PROPERTY_WRITERS", "3")))
+    parser.add_argument("--interval", type=float,
+                        default=float(getenv("PROPERTY_CRAWL_INTERVAL_MINUTES", "60")),
+                        help="minutes between scheduled crawls")
+    parser.add_argument("--once", action="store_true",
+                        help="run a single crawl and exit")
+    parser.add_argument("--rebuild-property-stations", action="store_true",
+                        help="recompute the distances between all properties and stations and exit")
+    asyncio.run(main(parser.parse_args()))
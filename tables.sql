@@ -5,7 +5,8 @@ create table properties (
     price integer not null,
     bedrooms smallint,
     bathrooms smallint,
-    boolean historic default false
+    historic boolean not null default false,
+    listing_hash bigint -- of the listing fields, unchanged listings are not rewritten
 );
 
 create table stations (
@@ -30,14 +31,100 @@ create table journeys (
     day_of_week day_of_week,
     rail_card varchar(3),
     checked_at timestamp without time zone not null default now(),
-    data jsonb not null,
+    data jsonb, -- raw api response, optional
+    -- summary of data, computed when cached
+    outbound_fastest_time smallint,
+    outbound_average_time smallint,
+    outbound_slowest_time smallint,
+    outbound_least_changes smallint,
+    outbound_most_changes smallint,
+    outbound_shortest_wait smallint,
+    outbound_average_wait smallint,
+    outbound_longest_wait smallint,
+    return_fastest_time smallint,
+    return_average_time smallint,
+    return_slowest_time smallint,
+    return_least_changes smallint,
+    return_most_changes smallint,
+    return_shortest_wait smallint,
+    return_average_wait smallint,
+    return_longest_wait smallint,
+    cheapest_return_price integer,
+    cheapest_return_type text,
+    cheapest_outward_single_price integer,
+    cheapest_outward_single_type text,
+    cheapest_inward_single_price integer,
+    cheapest_inward_single_type text,
+    summarised_at timestamp without time zone, -- null for rows cached before the summary columns, which are summarised from data on read
     primary key (origin, destination, start_time, start_type, return_time, return_type, day_of_week, rail_card)
 );
 
+create table journey_searches (
+    destination varchar(3) not null,
+    start_time time not null,
+    start_type journey_type not null,
+    return_time time not null,
+    return_type journey_type not null,
+    day_of_week day_of_week not null,
+    rail_card varchar(3),
+    searched_at timestamp without time zone not null default now()
+);
+
+create index journey_searches_searched_at on journey_searches (searched_at);
+
+create type crawl_status as enum ('PENDING', 'RUNNING', 'SPLIT', 'COMPLETE', 'FAILED');
+
+create table crawl_runs (
+    id serial primary key,
+    max_price integer not null,
+    radius integer not null,
+    status crawl_status not null default 'RUNNING',
+    started_at timestamp without time zone not null default now(),
+    finished_at timestamp without time zone,
+    pages integer not null default 0,
+    listings integer not null default 0,
+    rows_written integer not null default 0
+);
+
+-- one row per search tile of a run, checkpointed by the writers
+create table crawl_progress (
+    run_id integer not null references crawl_runs(id) on delete cascade,
+    tile text not null, -- min longitude, min latitude, max longitude, max latitude
+    status crawl_status not null default 'PENDING',
+    next_index integer not null default 0,
+    pages integer not null default 0,
+    started_at timestamp without time zone,
+    finished_at timestamp without time zone,
+    primary key (run_id, tile)
+);
+
+create index crawl_progress_finished_at on crawl_progress (tile, finished_at) where status = 'COMPLETE';
+
+-- the listings seen by a run, listings not seen by a complete run are marked historic
+create table crawl_seen_listings (
+    run_id integer not null references crawl_runs(id) on delete cascade,
+    property_id bigint not null,
+    tile text not null, -- copied with the tile when a later run takes it over
+    primary key (run_id, property_id, tile)
+);
+
 CREATE INDEX properties_location ON properties USING GIST (location);
 
+-- longitude and latitude boxes, e.g. the bounds of the property tiles
+create index properties_location_geometry on properties using gist ((location::geometry));
+
 CREATE INDEX stations_location ON stations USING GIST (location);
 
+-- stations within PROPERTY_STATION_MAX_DISTANCE_METERS of each property, refreshed when properties are written
+create table property_station (
+    property_id bigint not null references properties(id) on delete cascade,
+    station_id varchar(3) not null references stations(id) on delete cascade,
+    distance_m real not null,
+    primary key (property_id, station_id)
+);
+
+create index property_station_station on property_station (station_id, distance_m) include (property_id);
+
 create table users (
     username text not null primary key,
     password text not null   